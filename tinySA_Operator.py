@@ -1,40 +1,71 @@
 import serial
 import time
-from typing import Dict, Any, Optional, List, Union
+from typing import Dict, Any, Optional, List, Tuple, Union
 import base64
 import os
 import threading
 import queue
-from mcp.server.fastmcp import FastMCP, Image
+from mcp.server.fastmcp import FastMCP, Image, Context
 import mcp.types as types
 import struct
+import zlib
+import json
+import asyncio
+import argparse
+import collections
+import contextlib
+import functools
 import numpy as np
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from serial.tools import list_ports
 from PIL import Image as PILImage
 import io
 import tkinter as tk
 from tkinter import ttk, scrolledtext, filedialog
 
+class TinySACancelled(Exception):
+    """Raised when a command is cancelled or exceeds its deadline."""
+
+
+def write_log(log_callback, message, level="INFO"):
+    """タイムスタンプ付きのログメッセージをコールバック（未設定ならprint）に渡す"""
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    log_msg = f"[{timestamp}] [{level}] {message}"
+    if log_callback:
+        log_callback(log_msg)
+    else:
+        print(log_msg)
+
+
 # オリジナルのTinySASerialクラスを拡張してログ機能を追加
 class TinySASerial:
     """Class to handle serial communication with TinySA device."""
+
+    # コマンド応答の終端に付くプロンプト
+    PROMPT = b"ch> "
+    # 読み込み中にキャンセルを確認する間隔（秒）
+    POLL_INTERVAL = 0.02
+    # 掃引を伴うコマンド（scan, scanraw）の既定の待ち時間（秒）
+    SCAN_TIMEOUT = 60.0
     
-    def __init__(self, port: Optional[str] = None, baudrate: int = 9600, log_callback=None):
+    def __init__(self, port: Optional[str] = None, baudrate: int = 9600, log_callback=None, timeout: float = 3):
         self.port = port
         self.baudrate = baudrate
-        self.timeout = 3
+        self.timeout = timeout
         self.serial_conn: Optional[serial.Serial] = None
         self.connected = False
         self.log_callback = log_callback  # ログ表示用コールバック関数
+        # 実行中のコマンドを中断するためのフラグと期限（time.monotonic基準）
+        self.cancel_event = threading.Event()
+        self.deadline: Optional[float] = None
+        # 通信の記録先と再生元（どちらも未設定なら実機と通信する）
+        self.recorder: Optional["SessionRecorder"] = None
+        self.replay: Optional["SessionReplay"] = None
     
     def log(self, message, level="INFO"):
         """ログメッセージを記録する"""
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-        log_msg = f"[{timestamp}] [{level}] {message}"
-        if self.log_callback:
-            self.log_callback(log_msg)
-        else:
-            print(log_msg)
+        write_log(self.log_callback, message, level)
     
     def connect(self, port: Optional[str] = None) -> bool:
         """Connect to TinySA device. Port is required if not already set."""
@@ -45,12 +76,7 @@ class TinySASerial:
             return False
         try:
             self.log(f"Connecting to TinySA on port {self.port}...")
-            self.serial_conn = serial.Serial(
-                port=self.port,
-                baudrate=self.baudrate,
-                timeout=self.timeout,
-                write_timeout=self.timeout
-            )
+            self.serial_conn = self.open_serial()
             self.connected = True
             self.log(f"Successfully connected to TinySA on port {self.port}", "SUCCESS")
             return True
@@ -59,6 +85,20 @@ class TinySASerial:
             self.connected = False
             return False
     
+    def open_serial(self):
+        """Open the serial connection, or a recorded session when replaying."""
+        if self.replay is not None:
+            return self.replay.open(self.port, timeout=self.POLL_INTERVAL)
+        conn = serial.Serial(
+            port=self.port,
+            baudrate=self.baudrate,
+            timeout=self.POLL_INTERVAL,
+            write_timeout=self.timeout
+        )
+        if self.recorder is not None:
+            conn = RecordingSerial(conn, self.recorder)
+        return conn
+
     def disconnect(self) -> None:
         """Disconnect from TinySA device."""
         if self.serial_conn and self.serial_conn.is_open:
@@ -75,7 +115,7 @@ class TinySASerial:
             self.log(f"TX: {command.strip()}")
             self.serial_conn.write(command.encode('utf-8'))
             self.log(f"Reading image data...")
-            data = self.serial_conn.read(307200)
+            data = self.read_response(307200)
             self.log(f"RX: Image data received ({len(data)} bytes)")
             ans = bytearray(307200)
             ans[0:len(data)] = data            
@@ -105,6 +145,7 @@ class TinySASerial:
             # Read response
             response = ""
             while self.serial_conn.in_waiting:
+                self.check_cancel()
                 chunk = self.serial_conn.read(self.serial_conn.in_waiting).decode('utf-8', errors='replace')
                 response += chunk
                 self.log(f"RX: {chunk.strip()}")
@@ -114,6 +155,226 @@ class TinySASerial:
         except (serial.SerialException, OSError) as e:
             self.log(f"Error communicating with TinySA: {e}", "ERROR")
             raise Exception(f"Error communicating with TinySA: {e}")
+
+    def query(self, command: str, timeout: Optional[float] = None) -> str:
+        """Send command and read the response up to the "ch>" prompt.
+
+        Unlike send_command, this does not rely on fixed sleeps, so it returns
+        as soon as the device has answered. The command echo and the prompt
+        are stripped from the returned text.
+        """
+        if not self.connected or not self.serial_conn:
+            self.log("Not connected to TinySA device. Please execute connect command.", "ERROR")
+            raise Exception("Not connected to TinySA device. Please execute connect command.")
+
+        cmd = command.strip()
+        try:
+            self.serial_conn.reset_input_buffer()
+            self.log(f"TX: {cmd}")
+            self.serial_conn.write((cmd + "\r").encode('utf-8'))
+            data = self.read_until_prompt(timeout)
+        except (serial.SerialException, OSError) as e:
+            self.log(f"Error communicating with TinySA: {e}", "ERROR")
+            raise Exception(f"Error communicating with TinySA: {e}")
+
+        lines = data[:-len(self.PROMPT)].decode('utf-8', errors='replace').replace('\r', '').split('\n')
+        # 先頭行はコマンドのエコーバック
+        if lines and lines[0].strip() == cmd:
+            lines = lines[1:]
+        response = "\n".join(lines).strip()
+        self.log(f"RX: {response}")
+        return response
+
+    def read_until_prompt(self, timeout: Optional[float] = None) -> bytes:
+        """Read raw bytes until the "ch>" prompt arrives or the timeout expires."""
+        data = self.read_response(terminator=self.PROMPT, timeout=timeout)
+        if not data.endswith(self.PROMPT):
+            self.log(f"Timed out waiting for prompt ({len(data)} bytes received)", "ERROR")
+            raise Exception(f"Timed out waiting for TinySA prompt ({len(data)} bytes received)")
+        return data
+
+    def check_cancel(self) -> None:
+        """Raise TinySACancelled if the command was cancelled or its deadline passed."""
+        if self.cancel_event.is_set():
+            raise TinySACancelled("Command cancelled")
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise TinySACancelled("Command deadline exceeded")
+
+    def read_response(self, size: Optional[int] = None, terminator: Optional[bytes] = None,
+                      timeout: Optional[float] = None, max_chunk: Optional[int] = None) -> bytes:
+        """Read size bytes, or up to the terminator, in short polls.
+
+        Returns what has arrived when the timeout expires. Between polls the
+        cancel flag and the command deadline are checked, so a long transfer
+        can be aborted within POLL_INTERVAL. Bytes received after the
+        terminator are dropped unless max_chunk limits how far ahead is read.
+        """
+        end = time.monotonic() + (self.timeout if timeout is None else timeout)
+        data = bytearray()
+        while time.monotonic() < end:
+            self.check_cancel()
+            want = max(1, self.serial_conn.in_waiting)
+            if size is not None:
+                want = min(want, size - len(data))
+            if max_chunk:
+                want = min(want, max_chunk)
+            chunk = self.serial_conn.read(want)
+            data += chunk
+            if size is not None and len(data) >= size:
+                break
+            if terminator is not None and chunk:
+                index = data.find(terminator, max(0, len(data) - len(chunk) - len(terminator) + 1))
+                if index >= 0:
+                    del data[index + len(terminator):]
+                    break
+        return bytes(data)
+
+    def resync(self, timeout: float = 2.0) -> bool:
+        """Discard the rest of an aborted transfer and wait for the "ch>" prompt.
+
+        Returns True when the device answered with a prompt, so the port can
+        be used for the next command right away.
+        """
+        self.cancel_event.clear()
+        self.deadline = None
+        if not self.serial_conn or not self.serial_conn.is_open:
+            return False
+        end = time.monotonic() + timeout
+        try:
+            # 中断した転送の残りを、受信が止まるまで読み捨てる
+            quiet_since = time.monotonic()
+            while time.monotonic() < end:
+                waiting = self.serial_conn.in_waiting
+                if waiting:
+                    self.serial_conn.read(waiting)
+                    quiet_since = time.monotonic()
+                elif time.monotonic() - quiet_since > self.POLL_INTERVAL:
+                    break
+                else:
+                    time.sleep(self.POLL_INTERVAL / 4)
+            self.serial_conn.write(b"\r")
+            data = self.read_response(terminator=self.PROMPT, timeout=max(end - time.monotonic(), 0.1))
+        except (serial.SerialException, OSError) as e:
+            self.log(f"Error resynchronizing with TinySA: {e}", "ERROR")
+            return False
+        if data.endswith(self.PROMPT):
+            self.log("Resynchronized to TinySA prompt")
+            return True
+        self.log("TinySA did not return to the prompt after cancellation", "ERROR")
+        return False
+
+    def reset(self, timeout: float = 15.0) -> None:
+        """Reboot the TinySA with "reset" and reconnect once it answers again.
+
+        The device restarts without returning the prompt and its USB serial
+        port disappears for a moment, so the connection is reopened until a
+        "version" query succeeds or the timeout expires.
+        """
+        if not self.connected or not self.serial_conn:
+            self.log("Not connected to TinySA device. Please execute connect command.", "ERROR")
+            raise Exception("Not connected to TinySA device. Please execute connect command.")
+        self.log("TX: reset")
+        try:
+            self.serial_conn.write(b"reset\r")
+        except (serial.SerialException, OSError):
+            # 書き込みと同時に切断されることがある
+            pass
+        self.disconnect()
+        end = time.monotonic() + timeout
+        time.sleep(0.5)
+        while time.monotonic() < end:
+            self.check_cancel()
+            try:
+                self.serial_conn = self.open_serial()
+                self.connected = True
+                self.query("version", timeout=1.0)
+                self.log(f"TinySA on port {self.port} is back after reset", "SUCCESS")
+                return
+            except TinySACancelled:
+                raise
+            except Exception:
+                # 再起動中はポートが開けないか、応答がない
+                self.disconnect()
+                time.sleep(0.5)
+        self.log("TinySA did not come back after reset", "ERROR")
+        raise Exception(f"TinySA on port {self.port} did not come back after reset")
+
+    def get_device_id(self) -> Optional[int]:
+        """Get the user settable device id of the TinySA, or None if unavailable."""
+        response = self.query("deviceid")
+        for token in reversed(response.split()):
+            if token.isdigit():
+                return int(token)
+        return None
+
+    def get_trace(self, trace: int = 2) -> np.ndarray:
+        """Get trace data (0=temp value, 1=stored trace, 2=measurement) in dBm."""
+        response = self.query(f"data {trace}")
+        return np.array(response.split(), dtype=np.float64)
+
+    def get_frequencies(self) -> np.ndarray:
+        """Get the frequencies of the last sweep in Hz."""
+        response = self.query("frequencies")
+        return np.array(response.split(), dtype=np.float64)
+
+    def get_sweep(self) -> Dict[str, float]:
+        """Get the current sweep start, stop and number of points."""
+        values = self.query("sweep").split()
+        return {"start": float(values[0]), "stop": float(values[1]), "points": int(values[2])}
+
+    def get_markers(self) -> List[Dict[str, Any]]:
+        """Get the active markers as a list of id, index, frequency and level."""
+        markers = []
+        for line in self.query("marker").split('\n'):
+            values = line.split()
+            if len(values) >= 4 and values[0].isdigit():
+                markers.append({
+                    "id": int(values[0]),
+                    "index": int(values[1]),
+                    "frequency": float(values[2]),
+                    "level": float(values[3]),
+                })
+        return markers
+
+    def scan_raw(self, start: float, stop: float, points: int,
+                 timeout: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Run a scanraw sweep and return the frequencies (Hz) and levels (dBm).
+
+        The binary response is '{' followed by ('x' LSB MSB) per point and '}'.
+        It is decoded directly with NumPy instead of building strings. The
+        sweep time depends on RBW, span and points, so without a timeout the
+        read waits until the command deadline, or SCAN_TIMEOUT if none is set.
+        """
+        if not self.connected or not self.serial_conn:
+            self.log("Not connected to TinySA device. Please execute connect command.", "ERROR")
+            raise Exception("Not connected to TinySA device. Please execute connect command.")
+
+        command = f"scanraw {int(start)} {int(stop)} {int(points)}"
+        size = 3 * int(points)
+        if timeout is None:
+            timeout = self.SCAN_TIMEOUT if self.deadline is None else max(self.deadline - time.monotonic(), 0.0)
+        try:
+            self.serial_conn.reset_input_buffer()
+            self.log(f"TX: {command}")
+            self.serial_conn.write((command + "\r").encode('utf-8'))
+            # エコーバックは1バイトずつ読み、'{'以降のバイナリを読み過ぎないようにする
+            header = self.read_response(terminator=b"{", timeout=timeout, max_chunk=1)
+            data = self.read_response(size=size + 1, timeout=timeout) if header.endswith(b"{") else b""
+            if len(data) == size + 1:
+                self.read_until_prompt(timeout)
+        except (serial.SerialException, OSError) as e:
+            self.log(f"Error communicating with TinySA: {e}", "ERROR")
+            raise Exception(f"Error communicating with TinySA: {e}")
+
+        if len(data) < size + 1 or data[size:size + 1] != b"}":
+            self.log(f"Incomplete scanraw data ({len(data)} bytes)", "ERROR")
+            raise Exception(f"Incomplete scanraw data ({len(data)} bytes)")
+        self.log(f"RX: scanraw data received ({size} bytes)")
+        # ファームウェアは値をリトルエンディアンで送信する
+        raw = np.frombuffer(data, dtype=[('x', 'u1'), ('value', '<u2')], count=int(points))
+        levels = raw['value'] / 32.0 - 128.0
+        frequencies = np.linspace(start, stop, int(points))
+        return frequencies, levels
     
     def get_version(self) -> Dict[str, str]:
         """Get TinySA version information."""
@@ -142,6 +403,1554 @@ class TinySASerial:
             raise Exception(f"Error getting TinySA version: {e}")
 
 
+# シリアル通信の記録と再生
+class SessionRecorder:
+    """Write timestamped TX/RX byte streams of TinySA sessions to a binary file.
+
+    The file starts with MAGIC, followed by records of
+    struct RECORD (kind, seconds since the recording started, length) and
+    the payload bytes. OPEN and CLOSE records carry the port name and
+    delimit one connection. Consecutive RX reads are merged into one record
+    per RX_MERGE_INTERVAL, which keeps the file close to the size of the
+    traffic itself.
+    """
+
+    MAGIC = b"TSAREC1\n"
+    RECORD = struct.Struct("<BdI")
+    TX, RX, OPEN, CLOSE = 0, 1, 2, 3
+    RX_MERGE_INTERVAL = 0.01
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "ab")
+        if new_file:
+            self.file.write(self.MAGIC)
+        self.t0 = time.monotonic()
+        self.rx_time = 0.0
+        self.rx_data = bytearray()
+
+    def record(self, kind: int, payload: bytes) -> None:
+        with self.lock:
+            if self.file.closed:
+                return
+            now = time.monotonic() - self.t0
+            if kind == self.RX:
+                if self.rx_data and now - self.rx_time > self.RX_MERGE_INTERVAL:
+                    self.flush_rx()
+                if not self.rx_data:
+                    self.rx_time = now
+                self.rx_data += payload
+                return
+            self.flush_rx()
+            self.file.write(self.RECORD.pack(kind, now, len(payload)))
+            self.file.write(payload)
+
+    def flush_rx(self) -> None:
+        if self.rx_data:
+            self.file.write(self.RECORD.pack(self.RX, self.rx_time, len(self.rx_data)))
+            self.file.write(self.rx_data)
+            self.rx_data = bytearray()
+
+    def close(self) -> None:
+        with self.lock:
+            if not self.file.closed:
+                self.flush_rx()
+                self.file.close()
+
+
+class RecordingSerial:
+    """serial.Serial wrapper that records every byte written and read."""
+
+    def __init__(self, conn, recorder: SessionRecorder):
+        self.conn = conn
+        self.recorder = recorder
+        recorder.record(SessionRecorder.OPEN, str(conn.port).encode('utf-8'))
+
+    @property
+    def timeout(self):
+        return self.conn.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.conn.timeout = value
+
+    @property
+    def in_waiting(self) -> int:
+        return self.conn.in_waiting
+
+    @property
+    def is_open(self) -> bool:
+        return self.conn.is_open
+
+    def write(self, data: bytes) -> int:
+        self.recorder.record(SessionRecorder.TX, bytes(data))
+        return self.conn.write(data)
+
+    def read(self, size: int = 1) -> bytes:
+        data = self.conn.read(size)
+        if data:
+            self.recorder.record(SessionRecorder.RX, data)
+        return data
+
+    def reset_input_buffer(self) -> None:
+        self.conn.reset_input_buffer()
+
+    def close(self) -> None:
+        self.recorder.record(SessionRecorder.CLOSE, b"")
+        self.conn.close()
+
+
+class SessionReplay:
+    """Recorded TinySA session that can be played back through TinySASerial.
+
+    Each connect() takes the next recorded connection. The RX bytes that
+    followed a TX in the recording become readable at their original delay
+    after the same TX is written, divided by speed. speed=0 delivers them
+    immediately, for benchmarking parsers and decoders offline.
+
+    RX is timestamped when the recorded program read it, which is at or
+    after its arrival, so bytes are released up to slack seconds early.
+    """
+
+    def __init__(self, path: str, speed: float = 1.0, log_callback=None, slack: float = 0.02):
+        self.path = path
+        self.speed = speed
+        self.slack = slack
+        self.log_callback = log_callback
+        self.records: List[Tuple[int, float, bytes]] = []
+        self.cursor = 0
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(SessionRecorder.MAGIC):
+            raise Exception(f"Not a TinySA session recording: {path}")
+        offset = len(SessionRecorder.MAGIC)
+        size = SessionRecorder.RECORD.size
+        while offset + size <= len(data):
+            kind, t, length = SessionRecorder.RECORD.unpack_from(data, offset)
+            offset += size
+            self.records.append((kind, t, data[offset:offset + length]))
+            offset += length
+
+    def open(self, port: Optional[str] = None, timeout: float = TinySASerial.POLL_INTERVAL) -> "ReplaySerial":
+        """Return a serial-like object for the next recorded connection."""
+        while self.cursor < len(self.records) and self.records[self.cursor][0] != SessionRecorder.OPEN:
+            self.cursor += 1
+        if self.cursor >= len(self.records):
+            raise serial.SerialException(f"No more recorded connections in {self.path}")
+        self.cursor += 1
+        return ReplaySerial(self, timeout)
+
+
+class ReplaySerial:
+    """serial.Serial stand-in that answers from a SessionReplay."""
+
+    def __init__(self, replay: SessionReplay, timeout: float):
+        self.replay = replay
+        self.timeout = timeout
+        self.is_open = True
+        self.port = f"replay:{replay.path}"
+        self.buffer = bytearray()
+        self.pending: collections.deque = collections.deque()  # (到着時刻, データ)
+        self.schedule_rx(time.monotonic(), None)
+
+    def schedule_rx(self, now: float, anchor: Optional[float]) -> None:
+        """Queue the RX records up to the next TX relative to the time now."""
+        records = self.replay.records
+        while self.replay.cursor < len(records):
+            kind, t, payload = records[self.replay.cursor]
+            if kind != SessionRecorder.RX:
+                break
+            if anchor is None:
+                anchor = t
+            delay = (t - anchor) / self.replay.speed if self.replay.speed > 0 else 0.0
+            self.pending.append((now + delay, payload))
+            self.replay.cursor += 1
+
+    def pump(self) -> None:
+        now = time.monotonic() + self.replay.slack
+        while self.pending and self.pending[0][0] <= now:
+            self.buffer += self.pending.popleft()[1]
+
+    @property
+    def in_waiting(self) -> int:
+        self.pump()
+        return len(self.buffer)
+
+    def write(self, data: bytes) -> int:
+        records = self.replay.records
+        if self.replay.cursor < len(records) and records[self.replay.cursor][0] == SessionRecorder.TX:
+            kind, t, payload = records[self.replay.cursor]
+            if payload != bytes(data) and self.replay.log_callback:
+                self.replay.log_callback(f"[WARNING] Replay expected {payload!r} but got {bytes(data)!r}")
+            self.replay.cursor += 1
+            self.schedule_rx(time.monotonic(), t)
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        end = time.monotonic() + (self.timeout or 0)
+        while True:
+            self.pump()
+            if self.buffer or time.monotonic() >= end:
+                break
+            wait = self.pending[0][0] - self.replay.slack - time.monotonic() if self.pending else end - time.monotonic()
+            time.sleep(max(0.0, min(wait, end - time.monotonic())))
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def reset_input_buffer(self) -> None:
+        # 記録されているのはプログラムが実際に読んだバイトだけなので、破棄するものはない
+        pass
+
+    def close(self) -> None:
+        records = self.replay.records
+        if self.replay.cursor < len(records) and records[self.replay.cursor][0] == SessionRecorder.CLOSE:
+            self.replay.cursor += 1
+        self.is_open = False
+
+
+# シリアルポートの自動検出とデバイス識別情報のキャッシュ
+class TinySADiscovery:
+    """Discover TinySA devices on serial ports and cache their fingerprints.
+
+    Ports are probed in parallel with short-deadline "version" and "deviceid"
+    queries. Results are cached per port together with the USB hardware id,
+    so a later scan only probes ports whose USB identity changed. Ports that
+    did not answer as a TinySA are cached as well ("tinysa": False), so other
+    USB serial devices are not reopened on every scan.
+    """
+
+    def __init__(self, cache_path: Optional[str] = None, log_callback=None,
+                 probe_timeout: float = 0.5, max_workers: int = 8):
+        self.cache_path = cache_path or os.path.join(os.getcwd(), 'tinySA_devices.json')
+        self.log_callback = log_callback
+        self.probe_timeout = probe_timeout
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.devices: Dict[str, Dict[str, Any]] = self.load_cache()
+
+    def log(self, message, level="INFO"):
+        """ログメッセージを記録する"""
+        write_log(self.log_callback, message, level)
+
+    def load_cache(self) -> Dict[str, Dict[str, Any]]:
+        """Load the port to fingerprint mapping from the cache file."""
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self) -> None:
+        """Write the port to fingerprint mapping to the cache file."""
+        try:
+            with open(self.cache_path, "w", encoding="utf-8") as f:
+                json.dump(self.devices, f, indent=2)
+        except OSError as e:
+            self.log(f"Failed to save device cache: {e}", "ERROR")
+
+    def probe(self, port_info) -> Optional[Dict[str, Any]]:
+        """Probe one port and return its fingerprint, or None if it could not be opened.
+
+        Ports that were opened but did not answer as a TinySA get a
+        fingerprint with "tinysa" set to False.
+        """
+        device = TinySASerial(port=port_info.device, log_callback=self.log_callback,
+                              timeout=self.probe_timeout)
+        if not device.connect():
+            return None
+        other = {"port": port_info.device, "hwid": port_info.hwid, "tinysa": False}
+        try:
+            lines = device.query("version").split('\n')
+            if not lines or "tinysa" not in lines[0].lower():
+                return other
+            fingerprint = {
+                "port": port_info.device,
+                "hwid": port_info.hwid,
+                "tinysa": True,
+                "firmware": lines[0].strip(),
+                "hardware": lines[1].strip() if len(lines) > 1 else "",
+                "device_id": None,
+            }
+            try:
+                fingerprint["device_id"] = device.get_device_id()
+            except Exception:
+                # deviceidに対応していないファームウェア
+                pass
+            return fingerprint
+        except Exception as e:
+            self.log(f"Port {port_info.device} did not answer as a TinySA: {e}")
+            return other
+        finally:
+            device.disconnect()
+
+    def scan(self, force: bool = False, usb_only: bool = True, guard=None,
+             recheck: bool = False) -> List[Dict[str, Any]]:
+        """Enumerate serial ports and return fingerprints of the TinySA devices found.
+
+        Args:
+            force: Probe every port even if its cached USB identity is unchanged.
+            usb_only: Skip ports without a USB vendor id (legacy UARTs).
+            guard: guard(port) returns a context manager held while the port is
+                probed; it yields False for ports that must not be opened now,
+                which keep their cached entry.
+            recheck: Probe the ports cached as TinySA again, e.g. because a
+                device id was changed with "deviceid". Other cached ports are kept.
+        """
+        ports = [p for p in list_ports.comports() if p.vid is not None or not usb_only]
+        with self.lock:
+            cached = dict(self.devices)
+
+        to_probe = []
+        found: Dict[str, Dict[str, Any]] = {}
+        for port_info in ports:
+            entry = cached.get(port_info.device)
+            if (not force and entry and entry.get("hwid") == port_info.hwid
+                  and not (recheck and entry.get("tinysa", True))):
+                found[port_info.device] = entry
+            else:
+                to_probe.append(port_info)
+
+        def probe_port(port_info):
+            if guard is None:
+                return self.probe(port_info)
+            with guard(port_info.device) as free:
+                # 使用中のポートは開かず、キャッシュの内容を残す
+                return self.probe(port_info) if free else cached.get(port_info.device)
+
+        self.log(f"Discovering TinySA devices: {len(found)} cached, {len(to_probe)} to probe")
+        if to_probe:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(to_probe))) as executor:
+                for fingerprint in executor.map(probe_port, to_probe):
+                    if fingerprint:
+                        found[fingerprint["port"]] = fingerprint
+
+        with self.lock:
+            self.devices = found
+            self.save_cache()
+        return [entry for entry in found.values() if entry.get("tinysa", True)]
+
+    def find_port(self, device_id: Union[int, str], guard=None) -> Optional[str]:
+        """Return the port of the device with the given id, rescanning only on a cache miss.
+
+        On a miss the cached TinySA ports are probed again as well, since the
+        id of a device can change without its USB identity changing. guard is
+        passed on to scan.
+        """
+        device_id = str(device_id)
+        for refresh in (False, True):
+            if refresh:
+                self.scan(guard=guard, recheck=True)
+            with self.lock:
+                for entry in self.devices.values():
+                    if entry.get("tinysa", True) and str(entry.get("device_id")) == device_id:
+                        return entry["port"]
+        return None
+
+
+def parse_frequency(text: Union[str, float, int]) -> float:
+    """Parse a TinySA frequency such as "92.5M", "500k" or "12000000" into Hz."""
+    if isinstance(text, (int, float)):
+        return float(text)
+    value = str(text).strip()
+    multipliers = {"k": 1e3, "K": 1e3, "M": 1e6, "G": 1e9}
+    if value and value[-1] in multipliers:
+        return float(value[:-1]) * multipliers[value[-1]]
+    return float(value)
+
+
+# 装置の現在設定のシャドーモデル
+class TinySAStateModel:
+    """Shadow copy of the settings this server has sent to one TinySA.
+
+    Only settings that went through the server are known. Commands with an
+    effect the model cannot follow (load, touch, ...) clear the model, so
+    every setting is sent again and the next recipe run starts from a real
+    reset. Changing the mode also forgets the sweep range.
+    """
+
+    # 引数付きで送ると設定を変更する単純なコマンド
+    SIMPLE_SETTINGS = ("mode", "rbw", "calc", "attenuate", "spur", "sweeptime", "trigger",
+                       "ext_gain", "if", "level", "levelchange", "output", "modulation",
+                       "caloutput", "refresh")
+    # 設定を変更しない問い合わせコマンド
+    QUERY_COMMANDS = ("version", "deviceid", "info", "help", "data", "frequencies", "vbat",
+                      "threads", "capture", "scan", "scanraw", "hop", "trace", "pause", "resume")
+    # resetを省略する場合に個別に初期値へ戻せる設定
+    RESTORE_COMMANDS = {
+        "calc": "calc off",
+        "marker.2.on": "marker 2 off", "marker.2.pos": "marker 2 off",
+        "marker.3.on": "marker 3 off", "marker.3.pos": "marker 3 off",
+        "marker.4.on": "marker 4 off", "marker.4.pos": "marker 4 off",
+    }
+
+    def __init__(self):
+        self.settings: Dict[str, Any] = {}
+        self.dirty: set = set()  # 最後のreset以降に変更した設定
+        self.trusted = False     # reset以降の変更を全て把握しているか
+
+    @staticmethod
+    def normalize(value: str) -> Any:
+        """Normalize a setting value so equal settings compare equal."""
+        try:
+            return parse_frequency(value)
+        except ValueError:
+            return value.lower()
+
+    def effects(self, command: str) -> Optional[Dict[str, Any]]:
+        """Return the settings a command would leave behind.
+
+        Returns an empty dict for commands without effect on the model and
+        None for commands whose effect is unknown. A value of None means the
+        setting becomes unknown.
+        """
+        words = command.split()
+        if not words:
+            return {}
+        name, args = words[0].lower(), words[1:]
+        if name in self.QUERY_COMMANDS or not args:
+            return {}
+        if name in self.SIMPLE_SETTINGS:
+            return {name: self.normalize(" ".join(args))}
+        if name == "sweep":
+            return self.sweep_effects(args)
+        if name == "marker" and len(args) >= 2:
+            marker = args[0]
+            action = args[1].lower()
+            if action == "off":
+                return {f"marker.{marker}.on": "off"}
+            if action == "on":
+                return {f"marker.{marker}.on": "on"}
+            if action == "peak":
+                # ピーク位置は毎回変わるので常に送信する
+                return {f"marker.{marker}.on": "on", f"marker.{marker}.pos": None}
+            return {f"marker.{marker}.on": "on", f"marker.{marker}.pos": self.normalize(args[1])}
+        return None
+
+    def sweep_effects(self, args: List[str]) -> Optional[Dict[str, Any]]:
+        """Translate the sweep command variants into start/stop settings."""
+        start = self.settings.get("sweep.start")
+        stop = self.settings.get("sweep.stop")
+        keyword = args[0].lower()
+        try:
+            if keyword in ("start", "stop") and len(args) >= 2:
+                return {f"sweep.{keyword}": parse_frequency(args[1])}
+            if keyword in ("center", "span") and len(args) >= 2:
+                value = parse_frequency(args[1])
+                if start is None or stop is None:
+                    return {"sweep.start": None, "sweep.stop": None}
+                center, span = (start + stop) / 2, stop - start
+                if keyword == "center":
+                    center = value
+                else:
+                    span = value
+                return {"sweep.start": center - span / 2, "sweep.stop": center + span / 2}
+            if keyword == "cw" and len(args) >= 2:
+                value = parse_frequency(args[1])
+                return {"sweep.start": value, "sweep.stop": value}
+            if len(args) >= 2:
+                effects = {"sweep.start": parse_frequency(args[0]), "sweep.stop": parse_frequency(args[1])}
+                if len(args) >= 3:
+                    effects["sweep.points"] = int(args[2])
+                return effects
+        except ValueError:
+            pass
+        return None
+
+    def is_redundant(self, command: str) -> bool:
+        """True if sending the command would not change any known setting."""
+        effects = self.effects(command)
+        if not effects:
+            return False
+        return all(value is not None and key in self.settings and self.settings[key] == value
+                   for key, value in effects.items())
+
+    def observe(self, command: str) -> None:
+        """Update the model after a command has been sent to the device."""
+        if command.split()[:1] and command.split()[0].lower() == "reset":
+            self.settings.clear()
+            self.dirty.clear()
+            self.trusted = True
+            return
+        effects = self.effects(command)
+        if effects is None:
+            self.forget()
+            return
+        if "mode" in effects and effects["mode"] != self.settings.get("mode"):
+            # モードを切り替えると掃引範囲も変わる
+            for key in ("sweep.start", "sweep.stop"):
+                self.settings.pop(key, None)
+                self.dirty.add(key)
+        for key, value in effects.items():
+            if value is None:
+                self.settings.pop(key, None)
+            else:
+                self.settings[key] = value
+            self.dirty.add(key)
+
+    def forget(self) -> None:
+        """Mark every setting unknown, e.g. after an unknown or failed command."""
+        self.settings.clear()
+        self.dirty.clear()
+        self.trusted = False
+
+    def plan(self, commands: List[str]) -> List[str]:
+        """Return the commands that actually need to be sent to reach the recipe state.
+
+        A reset is skipped when every setting changed since the last reset is
+        either set again by the following commands or can be restored
+        individually; the restore commands are sent in its place.
+        """
+        planned = []
+        shadow = TinySAStateModel()
+        shadow.settings = dict(self.settings)
+        shadow.dirty = set(self.dirty)
+        shadow.trusted = self.trusted
+        for i, command in enumerate(commands):
+            if command.split()[:1] and command.split()[0].lower() == "reset":
+                following = []
+                for next_command in commands[i + 1:]:
+                    if next_command.split()[:1] and next_command.split()[0].lower() == "reset":
+                        break
+                    following.append(next_command)
+                restore = shadow.restore_commands(following)
+                if restore is None:
+                    planned.append(command)
+                    shadow.observe(command)
+                else:
+                    for restore_command in restore:
+                        planned.append(restore_command)
+                        shadow.observe(restore_command)
+                continue
+            if shadow.is_redundant(command):
+                continue
+            planned.append(command)
+            shadow.observe(command)
+        return planned
+
+    def restore_commands(self, following: List[str]) -> Optional[List[str]]:
+        """Commands that replace a reset before the given commands, or None if a reset is needed."""
+        if not self.trusted:
+            return None
+        overwritten = set()
+        for command in following:
+            effects = self.effects(command)
+            if effects is None:
+                return None
+            overwritten.update(effects)
+        restore = []
+        for key in sorted(self.dirty - overwritten):
+            if key not in self.RESTORE_COMMANDS:
+                return None
+            if self.RESTORE_COMMANDS[key] not in restore:
+                restore.append(self.RESTORE_COMMANDS[key])
+        return restore
+
+
+# 名前付き測定レシピ
+class TinySARecipeEngine:
+    """Named measurement recipes run against a shadow model of each device.
+
+    A recipe is a list of command templates with "{param}" placeholders and
+    default parameter values. Running a recipe sends only the commands that
+    change the device state according to the per-port TinySAStateModel.
+    """
+
+    BUILTIN_RECIPES = {
+        "fm_survey": {
+            "description": "Wide FM band survey with max hold.",
+            "params": {"start": "76M", "stop": "108M", "rbw": "100", "calc": "maxh"},
+            "steps": ["reset", "mode low input", "sweep start {start}", "sweep stop {stop}",
+                      "rbw {rbw}", "calc {calc}"],
+        },
+        "detail_zoom": {
+            "description": "Zoom in on a signal and put marker 1 on its peak.",
+            "params": {"center": "92.4M", "span": "2M", "rbw": "30"},
+            "steps": ["sweep center {center}", "sweep span {span}", "rbw {rbw}", "marker 1 peak"],
+        },
+        "multi_marker_compare": {
+            "description": "Compare the strongest signal with two other frequencies.",
+            "params": {"freq2": "81.5M", "freq3": "83.1M"},
+            "steps": ["marker 1 peak", "marker 2 on", "marker 2 {freq2}", "marker 3 on",
+                      "marker 3 {freq3}", "marker"],
+        },
+    }
+
+    def __init__(self, recipe_path: Optional[str] = None, log_callback=None):
+        self.recipe_path = recipe_path or os.path.join(os.getcwd(), 'tinySA_recipes.json')
+        self.log_callback = log_callback
+        self.lock = threading.Lock()
+        self.states: Dict[str, TinySAStateModel] = {}
+        self.recipes: Dict[str, Dict[str, Any]] = dict(self.BUILTIN_RECIPES)
+        try:
+            with open(self.recipe_path, "r", encoding="utf-8") as f:
+                self.recipes.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def state(self, port: str) -> TinySAStateModel:
+        """Return the shadow state of the device on the given port."""
+        with self.lock:
+            if port not in self.states:
+                self.states[port] = TinySAStateModel()
+            return self.states[port]
+
+    def define(self, name: str, steps: List[str], params: Optional[Dict[str, str]] = None,
+               description: str = "") -> None:
+        """Register a recipe and store it in the recipe file."""
+        with self.lock:
+            self.recipes[name] = {"description": description, "params": params or {}, "steps": steps}
+            user_recipes = {k: v for k, v in self.recipes.items()
+                            if self.BUILTIN_RECIPES.get(k) != v}
+            with open(self.recipe_path, "w", encoding="utf-8") as f:
+                json.dump(user_recipes, f, indent=2, ensure_ascii=False)
+
+    def expand(self, name: str, params: Optional[Dict[str, str]] = None) -> List[str]:
+        """Fill in the recipe parameters and return the full command list."""
+        if name not in self.recipes:
+            raise Exception(f"Unknown recipe: {name}")
+        recipe = self.recipes[name]
+        values = dict(recipe.get("params", {}))
+        values.update(params or {})
+        try:
+            return [step.format(**values) for step in recipe["steps"]]
+        except KeyError as e:
+            raise Exception(f"Missing parameter for recipe {name}: {e}")
+
+    def run(self, device: TinySASerial, name: str, params: Optional[Dict[str, str]] = None,
+            diff: bool = True) -> Dict[str, Any]:
+        """Run a recipe on a connected device and return the sent commands and responses."""
+        commands = self.expand(name, params)
+        state = self.state(device.port)
+        if not diff:
+            state.forget()
+        planned = state.plan(commands)
+        device.log(f"Recipe {name}: sending {len(planned)} of {len(commands)} commands")
+        results = []
+        for command in planned:
+            try:
+                if command.split()[0].lower() == "reset":
+                    # resetは装置を再起動するのでプロンプトが返らない
+                    device.reset()
+                    response = ""
+                else:
+                    response = device.query(command)
+            except Exception:
+                # 途中で失敗した場合、装置の状態は不明
+                state.forget()
+                raise
+            state.observe(command)
+            results.append({"command": command, "response": response})
+        return {
+            "recipe": name,
+            "total_commands": len(commands),
+            "sent_commands": len(planned),
+            "results": results,
+        }
+
+
+def decode_screen(data: bytes):
+    """Convert a 480x320 RGB565 "capture" framebuffer into a PIL image."""
+    # 画像を適切なサイズに整形
+    width = 480
+    height = 320
+    arr = np.frombuffer(data, dtype='>u2', count=width * height).astype(np.uint32)
+    reshaped = arr.reshape(height, width)
+    # そのままだとずれるので、少しシフトする
+    shift_amount = width // 100  # 画面を見て調整
+    # 各行をまとめてシフトして修正（マイナス値で右シフト）
+    fixed_arr = np.roll(reshaped, -shift_amount, axis=1).ravel()
+    # 色変換を続行
+    fixed_arr = 0xFF000000 + ((fixed_arr & 0xF800) >> 8) + ((fixed_arr & 0x07EF) << 8) + ((fixed_arr & 0x001F) << 19)
+    return PILImage.frombuffer('RGBA', (480, 320), fixed_arr, 'raw', 'RGBA', 0, 1)
+
+
+# 連続キャプチャ（読み込みと変換・エンコードを並行して行う）
+BURST_MAX_FRAMES = 600
+
+
+def capture_burst(device: TinySASerial, frames: int = 10, duration: Optional[float] = None,
+                  output: str = "gif", frame_directory: Optional[str] = None,
+                  workers: int = 2) -> Dict[str, Any]:
+    """Capture a sequence of screens, decoding and encoding on a worker pool.
+
+    The serial read of the next frame overlaps with the per-frame work on
+    the previous ones: palette quantization for "gif", PNG encoding for
+    "png" (animated PNG) and "frames" (written to frame_directory). Captures
+    stop after frames screens, or after duration seconds when it is given.
+    Returns the per-frame results ("encoded": quantized images, PNG bytes or
+    file paths), their capture times and timing statistics.
+    """
+    def process(index: int, data: bytes):
+        im = decode_screen(data).convert('RGB')
+        if output == "gif":
+            return im.quantize(colors=256, method=PILImage.Quantize.FASTOCTREE)
+        if output == "png":
+            buf = io.BytesIO()
+            im.save(buf, format='PNG')
+            return buf.getvalue()
+        path = os.path.join(frame_directory, f"frame_{index:04d}.png")
+        im.save(path)
+        return path
+
+    limit = BURST_MAX_FRAMES if duration else min(frames, BURST_MAX_FRAMES)
+    futures = []
+    times = []
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        while len(futures) < limit:
+            if duration and time.monotonic() - start >= duration:
+                break
+            device.check_cancel()
+            data = device.get_image_data()
+            times.append(time.monotonic() - start)
+            futures.append(executor.submit(process, len(futures), bytes(data)))
+        capture_time = time.monotonic() - start
+        encoded = [future.result() for future in futures]
+    total_time = time.monotonic() - start
+    count = len(encoded)
+    return {
+        "encoded": encoded,
+        "times": times,
+        "frames": count,
+        "capture_time": capture_time,
+        "total_time": total_time,
+        "capture_fps": count / capture_time if capture_time > 0 else 0.0,
+        "fps": count / total_time if total_time > 0 else 0.0,
+    }
+
+
+def write_apng(path: str, pngs: List[bytes], durations: List[int]) -> None:
+    """Assemble separately encoded PNG frames of the same size into an animated PNG.
+
+    Only the compressed image data of each frame is copied (as IDAT for the
+    first frame and fdAT for the others), so no frame is encoded again.
+    durations are the frame delays in milliseconds.
+    """
+    def chunks(png: bytes):
+        offset = 8
+        while offset < len(png):
+            length, kind = struct.unpack(">I4s", png[offset:offset + 8])
+            yield kind, png[offset + 8:offset + 8 + length]
+            offset += 12 + length
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    # 先頭フレームのIDAT以前のチャンク（IHDR等）をそのまま使う
+    header = []
+    for kind, data in chunks(pngs[0]):
+        if kind == b"IDAT":
+            break
+        header.append(chunk(kind, data))
+    width, height = struct.unpack(">II", next(chunks(pngs[0]))[1][:8])
+    out = [pngs[0][:8]] + header + [chunk(b"acTL", struct.pack(">II", len(pngs), 0))]
+    sequence = 0
+    for index, (png, delay) in enumerate(zip(pngs, durations)):
+        out.append(chunk(b"fcTL", struct.pack(">IIIIIHHBB", sequence, width, height, 0, 0,
+                                              min(delay, 65535), 1000, 0, 0)))
+        sequence += 1
+        for kind, data in chunks(png):
+            if kind != b"IDAT":
+                continue
+            if index == 0:
+                out.append(chunk(b"IDAT", data))
+            else:
+                out.append(chunk(b"fdAT", struct.pack(">I", sequence) + data))
+                sequence += 1
+    out.append(chunk(b"IEND", b""))
+    with open(path, "wb") as f:
+        f.write(b"".join(out))
+
+
+def save_to_img_directory(im, save_name: str, use_timestamp: bool = False, log=print) -> str:
+    """Save an image below the 'img' directory of the current directory and return its path."""
+    if use_timestamp:
+        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        path_parts = os.path.splitext(save_name)
+        save_name = f"{path_parts[0]}_{timestamp}{path_parts[1]}"
+
+    # Create 'img' directory in the current directory
+    img_directory = os.path.join(os.getcwd(), 'img')
+    os.makedirs(img_directory, exist_ok=True)
+
+    # Update save_name to be within the img directory
+    filename = os.path.basename(save_name)
+    save_path = os.path.join(img_directory, filename)
+
+    im.save(save_path)
+    log(f"Image saved to {save_path}")
+    return save_path
+
+
+# スペクトラム描画用の色
+PLOT_COLORS = {
+    "background": (0, 0, 0),
+    "grid": (64, 64, 64),
+    "axis": (160, 160, 160),
+    "text": (220, 220, 220),
+    "trace": (255, 255, 0),
+    "stored": (0, 200, 255),
+    "marker": (255, 80, 80),
+}
+
+
+def rasterize_trace(canvas: np.ndarray, x: np.ndarray, y: np.ndarray, color) -> None:
+    """Draw a polyline of pixel coordinates into an RGB canvas.
+
+    Each pixel column is filled between the lowest and highest point the
+    line passes through in that column, so dense traces keep their peaks
+    and sparse traces stay connected.
+    """
+    height, width = canvas.shape[:2]
+    columns = np.arange(width)
+    inside = (columns >= x.min()) & (columns <= x.max())
+    if not inside.any():
+        return
+    columns = columns[inside]
+    # 列ごとの補間値と、隣の列との間を結ぶ範囲
+    centre = np.interp(columns, x, y)
+    previous = np.interp(np.maximum(columns - 1, columns[0]), x, y)
+    low = np.minimum(centre, previous)
+    high = np.maximum(centre, previous)
+    # 1列に複数点が入る場合はその最小・最大も含める
+    index = np.clip(np.round(x).astype(np.int64), columns[0], columns[-1]) - columns[0]
+    np.minimum.at(low, index, y)
+    np.maximum.at(high, index, y)
+    low = np.clip(np.floor(low), 0, height - 1).astype(np.int64)
+    high = np.clip(np.ceil(high), 0, height - 1).astype(np.int64)
+    rows = np.arange(height)[:, None]
+    mask = (rows >= low[None, :]) & (rows <= high[None, :])
+    region = canvas[:, columns]
+    region[mask] = color
+    canvas[:, columns] = region
+
+
+def render_spectrum(frequencies: np.ndarray, levels: np.ndarray,
+                    overlays: Optional[List[np.ndarray]] = None,
+                    markers: Optional[List[Dict[str, Any]]] = None,
+                    width: int = 1200, height: int = 700,
+                    ref_level: Optional[float] = None, db_per_div: float = 10.0):
+    """Render a spectrum plot from trace data and return it as a PIL image.
+
+    The grid, traces and markers are rasterized with NumPy; only the axis
+    labels are drawn with PIL.
+    """
+    from PIL import ImageDraw
+
+    left, right, top, bottom = 70, 20, 30, 40
+    plot_w, plot_h = width - left - right, height - top - bottom
+    divisions = 10
+    if ref_level is None:
+        ref_level = float(np.ceil(np.nanmax(levels) / db_per_div) * db_per_div)
+    bottom_level = ref_level - db_per_div * divisions
+    f_start, f_stop = float(frequencies[0]), float(frequencies[-1])
+    f_span = (f_stop - f_start) or 1.0
+
+    def to_x(f):
+        return (np.asarray(f, dtype=np.float64) - f_start) / f_span * (plot_w - 1)
+
+    def to_y(level):
+        return (ref_level - np.asarray(level, dtype=np.float64)) / (ref_level - bottom_level) * (plot_h - 1)
+
+    canvas = np.empty((height, width, 3), dtype=np.uint8)
+    canvas[:] = PLOT_COLORS["background"]
+    plot = canvas[top:top + plot_h, left:left + plot_w]
+
+    # グリッド
+    grid_x = np.round(np.linspace(0, plot_w - 1, divisions + 1)).astype(np.int64)
+    grid_y = np.round(np.linspace(0, plot_h - 1, divisions + 1)).astype(np.int64)
+    plot[:, grid_x] = PLOT_COLORS["grid"]
+    plot[grid_y, :] = PLOT_COLORS["grid"]
+    plot[:, [0, plot_w - 1]] = PLOT_COLORS["axis"]
+    plot[[0, plot_h - 1], :] = PLOT_COLORS["axis"]
+
+    # トレース（保存トレースを先に描いて測定トレースを上に重ねる）
+    for overlay in overlays or []:
+        if len(overlay) == len(frequencies):
+            rasterize_trace(plot, to_x(frequencies), to_y(overlay), PLOT_COLORS["stored"])
+    rasterize_trace(plot, to_x(frequencies), to_y(levels), PLOT_COLORS["trace"])
+
+    # マーカー（縦の破線と三角形）
+    for marker in markers or []:
+        mx = int(round(float(to_x(marker["frequency"]))))
+        my = int(round(float(to_y(marker["level"]))))
+        if not 0 <= mx < plot_w:
+            continue
+        plot[0:plot_h:4, mx] = PLOT_COLORS["marker"]
+        for dy in range(8):
+            row = my - 2 - dy
+            if 0 <= row < plot_h:
+                plot[row, max(mx - dy // 2, 0):min(mx + dy // 2 + 1, plot_w)] = PLOT_COLORS["marker"]
+
+    im = PILImage.fromarray(canvas, 'RGB')
+    draw = ImageDraw.Draw(im)
+    for i, gy in enumerate(grid_y):
+        draw.text((4, top + gy - 6), f"{ref_level - i * db_per_div:.0f} dBm", fill=PLOT_COLORS["text"])
+    for i, gx in enumerate(grid_x[::2]):
+        f = f_start + f_span * (2 * i) / divisions
+        draw.text((left + gx - 24, top + plot_h + 8), f"{f / 1e6:.3f}M", fill=PLOT_COLORS["text"])
+    draw.text((left, 8), f"{len(frequencies)} points  start {f_start / 1e6:.3f} MHz  stop {f_stop / 1e6:.3f} MHz",
+              fill=PLOT_COLORS["text"])
+    for i, marker in enumerate(markers or []):
+        draw.text((left + plot_w - 260, top + 6 + 14 * i),
+                  f"M{marker['id']}: {marker['frequency'] / 1e6:.4f} MHz {marker['level']:.1f} dBm",
+                  fill=PLOT_COLORS["marker"])
+    return im
+
+
+# 掃引時間モデル
+class SweepTimeModel:
+    """Linear model of the sweep time of one TinySA.
+
+    time = overhead + points * (per_point + per_point_rbw / rbw_khz)
+
+    The per-point dwell time of the TinySA grows roughly with 1/RBW, which
+    the last term captures. The coefficients are fitted from timed sweeps.
+    """
+
+    # RBWの候補（kHz）とscanコマンド1回の最大ポイント数
+    RBW_OPTIONS = (3, 10, 30, 100, 300, 600)
+    MAX_SEGMENT_POINTS = 290
+    POINT_OPTIONS = (51, 101, 145, 201, 290)
+
+    def __init__(self, overhead: float, per_point: float, per_point_rbw: float):
+        self.overhead = overhead
+        self.per_point = per_point
+        self.per_point_rbw = per_point_rbw
+
+    @classmethod
+    def fit(cls, samples: List[Dict[str, float]]) -> "SweepTimeModel":
+        """Fit the model from samples with "points", "rbw" (kHz) and "time" (s)."""
+        points = np.array([s["points"] for s in samples], dtype=np.float64)
+        rbw = np.array([s["rbw"] for s in samples], dtype=np.float64)
+        times = np.array([s["time"] for s in samples], dtype=np.float64)
+        design = np.column_stack([np.ones_like(points), points, points / rbw])
+        coefficients, *_ = np.linalg.lstsq(design, times, rcond=None)
+        # 負の係数は物理的に意味がないので0に丸める
+        coefficients = np.maximum(coefficients, 0.0)
+        return cls(*coefficients.tolist())
+
+    def to_dict(self) -> Dict[str, float]:
+        return {"overhead": self.overhead, "per_point": self.per_point, "per_point_rbw": self.per_point_rbw}
+
+    def predict(self, points: int, rbw: float, segments: int = 1) -> float:
+        """Predict the wall-clock time in seconds of a sweep split into segments."""
+        return segments * self.overhead + points * (self.per_point + self.per_point_rbw / rbw)
+
+    def candidate(self, span: float, rbw: float, points: int) -> Dict[str, Any]:
+        """Describe one RBW/points setting with its predicted time and resolution."""
+        segments = int(np.ceil(points / self.MAX_SEGMENT_POINTS))
+        return {
+            "rbw": rbw,
+            "points": points,
+            "segments": segments,
+            "points_per_segment": int(np.ceil(points / segments)),
+            "predicted_time": self.predict(points, rbw, segments),
+            # 実効分解能はポイント間隔とRBWの大きい方
+            "resolution": max(span / max(points - 1, 1), rbw * 1e3),
+        }
+
+    def tune(self, span: float, time_budget: Optional[float] = None,
+             resolution: Optional[float] = None) -> Dict[str, Any]:
+        """Choose RBW, points and segmentation for a span.
+
+        With a resolution target (Hz) the fastest setting that reaches it is
+        chosen. With a time budget (s) only settings predicted to finish
+        within it are considered; without a resolution target the finest of
+        them is chosen. If no setting fits the budget, the fastest one is
+        used. If the target cannot be reached (within the budget), the finest
+        setting is chosen. within_budget and meets_resolution report which
+        constraints the result satisfies.
+        """
+        if not time_budget and not resolution:
+            raise Exception("Either time_budget or resolution is required.")
+        point_options = list(self.POINT_OPTIONS) + [self.MAX_SEGMENT_POINTS * n for n in range(2, 11)]
+        if resolution:
+            # 最小RBWより細かい目標では、それ以上ポイントを増やしても分解能は上がらない
+            for target in (resolution, max(resolution, self.RBW_OPTIONS[0] * 1e3)):
+                point_options.append(max(int(np.ceil(span / target)) + 1, 2))
+        candidates = [self.candidate(span, rbw, points)
+                      for rbw in self.RBW_OPTIONS for points in point_options]
+        fastest = min(candidates, key=lambda c: c["predicted_time"])
+        if time_budget:
+            pool = [c for c in candidates if c["predicted_time"] <= time_budget] or [fastest]
+        else:
+            pool = candidates
+
+        def reaches(c):
+            return resolution is None or c["resolution"] <= resolution * (1 + 1e-9)
+
+        meeting = [c for c in pool if reaches(c)] if resolution else []
+        if meeting:
+            result = min(meeting, key=lambda c: c["predicted_time"])
+        else:
+            result = min(pool, key=lambda c: (c["resolution"], c["predicted_time"]))
+        result["within_budget"] = time_budget is None or result["predicted_time"] <= time_budget
+        result["meets_resolution"] = reaches(result)
+        return result
+
+
+# 装置ごとの掃引時間モデルの校正と保存
+class TinySASweepTuner:
+    """Calibrate, store and apply per-device sweep time models."""
+
+    CALIBRATION_RBW = (10, 30, 100, 300)
+    CALIBRATION_POINTS = (51, 145, 290)
+
+    def __init__(self, model_path: Optional[str] = None, log_callback=None):
+        self.model_path = model_path or os.path.join(os.getcwd(), 'tinySA_sweep_models.json')
+        self.log_callback = log_callback
+        self.lock = threading.Lock()
+        try:
+            with open(self.model_path, "r", encoding="utf-8") as f:
+                self.models: Dict[str, Dict[str, Any]] = json.load(f)
+        except (OSError, ValueError):
+            self.models = {}
+
+    @staticmethod
+    def device_key(device: TinySASerial) -> str:
+        """Key a model by device id when one is set, otherwise by port."""
+        try:
+            device_id = device.get_device_id()
+        except Exception:
+            device_id = None
+        return f"deviceid:{device_id}" if device_id else f"port:{device.port}"
+
+    def calibrate(self, device: TinySASerial, start: float, stop: float,
+                  rbw_values=CALIBRATION_RBW, point_values=CALIBRATION_POINTS,
+                  state: Optional[TinySAStateModel] = None) -> Dict[str, Any]:
+        """Time scan runs over a grid of RBW and points, fit and store the model.
+
+        Each RBW change is recorded in state, when given, as soon as it is sent.
+        """
+        samples = []
+        for rbw in rbw_values:
+            device.query(f"rbw {rbw}")
+            if state is not None:
+                state.observe(f"rbw {rbw}")
+            for points in point_values:
+                t0 = time.perf_counter()
+                # scanは掃引が終わってからプロンプトを返す
+                device.query(f"scan {int(start)} {int(stop)} {int(points)}", timeout=device.SCAN_TIMEOUT)
+                elapsed = time.perf_counter() - t0
+                device.log(f"Sweep calibration: rbw {rbw} kHz, {points} points: {elapsed:.3f} s")
+                samples.append({"rbw": rbw, "points": points, "time": elapsed})
+        model = SweepTimeModel.fit(samples)
+        key = self.device_key(device)
+        with self.lock:
+            self.models[key] = {"model": model.to_dict(), "samples": samples,
+                                "calibrated": datetime.datetime.now().isoformat(timespec='seconds')}
+            with open(self.model_path, "w", encoding="utf-8") as f:
+                json.dump(self.models, f, indent=2)
+        return {"device": key, "model": model.to_dict(), "samples": samples}
+
+    def model(self, device: TinySASerial) -> SweepTimeModel:
+        """Return the stored model of the connected device."""
+        key = self.device_key(device)
+        with self.lock:
+            entry = self.models.get(key)
+        if not entry:
+            raise Exception(f"No sweep time model for {key}. Run calibrate_sweep_time first.")
+        return SweepTimeModel(**entry["model"])
+
+
+# 掃引データのファイル出力
+class TraceExporter:
+    """Append acquired sweeps to an NPZ, Parquet or CSV file straight from NumPy arrays.
+
+    Every format is appendable, so sweeps are written one by one as they are
+    acquired:
+    - npz: each sweep adds frequency_NNNNNN, level_NNNNNN and meta_NNNNNN
+      arrays to a compressed archive.
+    - parquet: the path is a dataset directory and each sweep is one part file
+      with columns sweep, timestamp, frequency, level, start, stop, points, rbw.
+    - csv: rows of sweep, timestamp, frequency, level, start, stop, points, rbw.
+    """
+
+    FORMATS = ("npz", "parquet", "csv")
+    META_DTYPE = np.dtype([("timestamp", "<f8"), ("start", "<f8"), ("stop", "<f8"),
+                           ("points", "<i8"), ("rbw", "<f8")])
+
+    def __init__(self, path: str, fmt: Optional[str] = None):
+        fmt = (fmt or os.path.splitext(path)[1].lstrip(".") or "npz").lower()
+        if fmt not in self.FORMATS:
+            raise Exception(f"Unsupported export format: {fmt}")
+        self.path = path
+        self.fmt = fmt
+        self.sweeps = 0
+        self.points = 0
+        self.level_min = np.inf
+        self.level_max = -np.inf
+        self.level_sum = 0.0
+        self.peak = (np.nan, -np.inf)
+
+    def next_index(self) -> int:
+        """Index of the next sweep, continuing an existing file."""
+        if self.fmt == "npz":
+            import zipfile
+            if not os.path.exists(self.path):
+                return 0
+            with zipfile.ZipFile(self.path, "r") as zf:
+                return sum(1 for name in zf.namelist() if name.startswith("level_"))
+        if self.fmt == "parquet":
+            if not os.path.isdir(self.path):
+                return 0
+            return sum(1 for name in os.listdir(self.path) if name.endswith(".parquet"))
+        if not os.path.exists(self.path):
+            return 0
+        # 最終行の掃引番号の次から続ける
+        with open(self.path, "rb") as f:
+            f.seek(max(0, os.path.getsize(self.path) - 4096))
+            last = f.read().rstrip(b"\r\n").rsplit(b"\n", 1)[-1]
+        try:
+            return int(last.split(b",", 1)[0]) + 1
+        except ValueError:
+            return 0
+
+    def append(self, frequencies: np.ndarray, levels: np.ndarray, timestamp: float,
+               rbw: float = np.nan) -> None:
+        """Write one sweep."""
+        index = self.next_index()
+        meta = np.array([(timestamp, frequencies[0], frequencies[-1], len(frequencies), rbw)],
+                        dtype=self.META_DTYPE)
+        if self.fmt == "npz":
+            self.append_npz(index, frequencies, levels, meta)
+        elif self.fmt == "parquet":
+            self.append_parquet(index, frequencies, levels, meta)
+        else:
+            self.append_csv(index, frequencies, levels, meta)
+
+        # 出力した掃引の統計
+        self.sweeps += 1
+        self.points += len(levels)
+        self.level_min = min(self.level_min, float(levels.min()))
+        self.level_max = max(self.level_max, float(levels.max()))
+        self.level_sum += float(levels.sum())
+        peak = int(np.argmax(levels))
+        if levels[peak] > self.peak[1]:
+            self.peak = (float(frequencies[peak]), float(levels[peak]))
+
+    def append_npz(self, index: int, frequencies, levels, meta) -> None:
+        import zipfile
+        with zipfile.ZipFile(self.path, "a", compression=zipfile.ZIP_DEFLATED) as zf:
+            for name, array in (("frequency", frequencies), ("level", levels), ("meta", meta)):
+                with zf.open(f"{name}_{index:06d}.npy", "w", force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.ascontiguousarray(array), allow_pickle=False)
+
+    def append_parquet(self, index: int, frequencies, levels, meta) -> None:
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception("Parquet export requires pyarrow (pip install pyarrow).")
+        os.makedirs(self.path, exist_ok=True)
+        n = len(levels)
+        table = pa.table({
+            "sweep": pa.array(np.full(n, index, dtype=np.int64)),
+            "timestamp": pa.array(np.full(n, meta["timestamp"][0])),
+            "frequency": pa.array(frequencies),
+            "level": pa.array(levels),
+            "start": pa.array(np.full(n, meta["start"][0])),
+            "stop": pa.array(np.full(n, meta["stop"][0])),
+            "points": pa.array(np.full(n, meta["points"][0], dtype=np.int64)),
+            "rbw": pa.array(np.full(n, meta["rbw"][0])),
+        })
+        pq.write_table(table, os.path.join(self.path, f"part-{index:06d}.parquet"), compression="zstd")
+
+    def append_csv(self, index: int, frequencies, levels, meta) -> None:
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, "a", newline="") as f:
+            if new_file:
+                f.write("sweep,timestamp,frequency,level,start,stop,points,rbw\n")
+            n = len(levels)
+            rows = np.column_stack([
+                np.full(n, index), np.full(n, meta["timestamp"][0]), frequencies, levels,
+                np.full(n, meta["start"][0]), np.full(n, meta["stop"][0]),
+                np.full(n, meta["points"][0]), np.full(n, meta["rbw"][0]),
+            ])
+            np.savetxt(f, rows, delimiter=",", fmt=["%d", "%.6f", "%.0f", "%.5f", "%.0f", "%.0f", "%d", "%g"])
+
+    def summary(self) -> Dict[str, Any]:
+        """Path and statistics of the sweeps written by this exporter."""
+        size = 0
+        if os.path.isdir(self.path):
+            size = sum(os.path.getsize(os.path.join(self.path, name)) for name in os.listdir(self.path))
+        elif os.path.exists(self.path):
+            size = os.path.getsize(self.path)
+        return {
+            "path": self.path,
+            "format": self.fmt,
+            "sweeps": self.sweeps,
+            "points": self.points,
+            "level_min": self.level_min if self.sweeps else None,
+            "level_max": self.level_max if self.sweeps else None,
+            "level_mean": self.level_sum / self.points if self.points else None,
+            "peak_frequency": self.peak[0] if self.sweeps else None,
+            "peak_level": self.peak[1] if self.sweeps else None,
+            "file_size": size,
+        }
+
+
+# 周波数割り当てデータベース（区間インデックス）
+class FrequencyAllocationIndex:
+    """Sorted interval index of frequency allocations and stations.
+
+    All allocation edges are merged into one sorted boundary array. For every
+    elementary segment between two boundaries the covering allocations are
+    precomputed in CSR form (indptr/ids), narrowest first, so looking up any
+    number of frequencies is one np.searchsorted call.
+
+    Entries are dicts with "name", "start" and "stop" in Hz and optionally
+    "service". Files may give "frequency" and "bandwidth" instead of
+    start/stop, and frequencies may use TinySA notation such as "80.0M".
+    """
+
+    DEFAULT_ALLOCATIONS = [
+        ("AM broadcast (MW)", "526.5k", "1606.5k", "broadcast"),
+        ("CB radio 27 MHz", "26.965M", "27.405M", "land mobile"),
+        ("Amateur 10 m", "28M", "29.7M", "amateur"),
+        ("Amateur 6 m", "50M", "54M", "amateur"),
+        ("FM broadcast (Japan)", "76M", "95M", "broadcast"),
+        ("FM broadcast", "87.5M", "108M", "broadcast"),
+        ("Aeronautical radionavigation (VOR/ILS)", "108M", "117.975M", "aeronautical"),
+        ("Aeronautical mobile (airband)", "117.975M", "137M", "aeronautical"),
+        ("Amateur 2 m", "144M", "148M", "amateur"),
+        ("Marine VHF", "156M", "162.025M", "maritime"),
+        ("DAB (Band III)", "174M", "240M", "broadcast"),
+        ("Amateur 70 cm", "430M", "440M", "amateur"),
+        ("ISM 433 MHz / LPD433", "433.05M", "434.79M", "ISM"),
+        ("PMR446", "446M", "446.2M", "land mobile"),
+        ("Digital TV (UHF)", "470M", "710M", "broadcast"),
+        ("SRD 868 MHz", "863M", "870M", "ISM"),
+        ("ISM 915 MHz", "902M", "928M", "ISM"),
+        ("Japan 920 MHz band", "915.9M", "929.7M", "ISM"),
+        ("ADS-B / SSR", "1089M", "1091M", "aeronautical"),
+        ("GNSS L1", "1559M", "1610M", "radionavigation"),
+        ("ISM 2.4 GHz (Wi-Fi/Bluetooth)", "2400M", "2500M", "ISM"),
+        ("ISM 5.8 GHz", "5725M", "5875M", "ISM"),
+    ]
+
+    def __init__(self, entries: Optional[List[Dict[str, Any]]] = None):
+        if entries is None:
+            entries = [{"name": n, "start": a, "stop": b, "service": s}
+                       for n, a, b, s in self.DEFAULT_ALLOCATIONS]
+        self.entries: List[Dict[str, Any]] = []
+        self.add(entries)
+
+    @staticmethod
+    def normalize(entry: Dict[str, Any]) -> Dict[str, Any]:
+        """Convert an entry to name/start/stop/service with start and stop in Hz."""
+        if "start" in entry and "stop" in entry:
+            start, stop = parse_frequency(entry["start"]), parse_frequency(entry["stop"])
+        elif "frequency" in entry:
+            center = parse_frequency(entry["frequency"])
+            half = parse_frequency(entry.get("bandwidth", 0)) / 2
+            start, stop = center - half, center + half
+        else:
+            raise Exception(f"Allocation needs start/stop or frequency: {entry}")
+        normalized = dict(entry)
+        normalized.update({"name": str(entry.get("name", "")), "start": min(start, stop),
+                           "stop": max(start, stop), "service": entry.get("service", "")})
+        normalized.pop("frequency", None)
+        normalized.pop("bandwidth", None)
+        return normalized
+
+    def add(self, entries: List[Dict[str, Any]]) -> None:
+        """Add entries and rebuild the index."""
+        self.entries.extend(self.normalize(entry) for entry in entries)
+        self.build()
+
+    def build(self) -> None:
+        starts = np.array([e["start"] for e in self.entries], dtype=np.float64)
+        # 終端の周波数も区間に含める
+        stops = np.nextafter(np.array([e["stop"] for e in self.entries], dtype=np.float64), np.inf)
+        self.boundaries = np.unique(np.concatenate([starts, stops]))
+        first = np.searchsorted(self.boundaries, starts)
+        last = np.searchsorted(self.boundaries, stops)
+        spans = last - first
+        # 各エントリが覆う区間番号を展開する
+        entry_ids = np.repeat(np.arange(len(self.entries)), spans)
+        offsets = np.repeat(np.cumsum(spans) - spans, spans)
+        segment_ids = np.arange(len(entry_ids)) - offsets + np.repeat(first, spans)
+        # 区間ごとに、狭い割り当て（より具体的なもの）を先に並べる
+        widths = (stops - starts)[entry_ids]
+        order = np.lexsort((widths, segment_ids))
+        self.ids = entry_ids[order]
+        self.indptr = np.searchsorted(segment_ids[order], np.arange(len(self.boundaries)))
+
+    def segments(self, frequencies: np.ndarray) -> np.ndarray:
+        """Elementary segment of each frequency, or -1 outside every allocation."""
+        segment = np.searchsorted(self.boundaries, np.asarray(frequencies, dtype=np.float64), side='right') - 1
+        segment[(segment < 0) | (segment >= len(self.boundaries) - 1)] = -1
+        return segment
+
+    def lookup(self, frequencies: np.ndarray) -> List[List[Dict[str, Any]]]:
+        """Return the matching entries of each frequency, narrowest first."""
+        segment = self.segments(frequencies)
+        if not self.entries:
+            return [[] for _ in segment]
+        valid = segment >= 0
+        begin = np.where(valid, self.indptr[np.maximum(segment, 0)], 0)
+        end = np.where(valid, self.indptr[np.maximum(segment, 0) + 1], 0)
+        return [[self.entries[i] for i in self.ids[b:e]] for b, e in zip(begin.tolist(), end.tolist())]
+
+    @classmethod
+    def load(cls, path: str) -> List[Dict[str, Any]]:
+        """Read entries from a JSON list or a CSV file with a header row."""
+        if path.lower().endswith(".json"):
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        import csv
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            return [{k: v for k, v in row.items() if v not in (None, "")} for row in csv.DictReader(f)]
+
+
+def find_peaks(frequencies: np.ndarray, levels: np.ndarray, threshold: Optional[float] = None,
+               max_peaks: Optional[int] = None) -> np.ndarray:
+    """Return the indices of local maxima above threshold, strongest first.
+
+    Without a threshold, peaks must stand 10 dB above the median level.
+    """
+    if threshold is None:
+        threshold = float(np.median(levels)) + 10.0
+    inner = levels[1:-1]
+    is_peak = (inner > levels[:-2]) & (inner >= levels[2:]) & (inner > threshold)
+    peaks = np.nonzero(is_peak)[0] + 1
+    peaks = peaks[np.argsort(levels[peaks])[::-1]]
+    return peaks[:max_peaks] if max_peaks else peaks
+
+
+# 複数クライアントからの装置アクセスを調停する
+class TinySADeviceArbiter:
+    """Serialize access to each TinySA port between MCP clients.
+
+    Every port has its own TinySASerial instance and at most one job runs on
+    it at a time. Waiting jobs are granted by priority class first
+    (interactive queries ahead of bulk acquisitions) and round-robin over
+    clients within a class, so a client queueing many requests cannot
+    starve the others. Blocking serial I/O runs in a worker thread to keep
+    the event loop free for other clients. A job that is cancelled or runs
+    past its deadline aborts its transfer and resynchronizes to the prompt;
+    a job that fails with any other error is resynchronized before the port
+    is released.
+    Read-only results can be shared: identical requests in flight are
+    coalesced and recent results are served from a short-lived cache.
+    """
+
+    # 優先度クラス（小さいほど先に実行）
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_BULK = 1
+
+    def __init__(self, log_callback=None):
+        self.log_callback = log_callback
+        self.devices: Dict[str, TinySASerial] = {}
+        self.busy: Dict[str, bool] = {}
+        # ポート → 優先度 → クライアント → 待ち行列
+        self.waiting: Dict[str, Dict[int, Dict[Any, collections.deque]]] = {}
+        self.turns: Dict[str, Dict[int, collections.deque]] = {}
+        self.cache: Dict[Tuple[str, str], Tuple[float, Any]] = {}
+        self.inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.recovering: set = set()
+        # クライアントごとに最後に使ったポート
+        self.last_ports: Dict[Any, str] = {}
+
+    def log(self, message, level="INFO"):
+        """ログメッセージを記録する"""
+        write_log(self.log_callback, message, level)
+
+    def device(self, port: str) -> TinySASerial:
+        """Return the TinySASerial instance of a port."""
+        if port not in self.devices:
+            self.devices[port] = TinySASerial(port=port, log_callback=self.log_callback)
+        return self.devices[port]
+
+    def busy_ports(self) -> List[str]:
+        """Ports with a job running."""
+        return [port for port, busy in self.busy.items() if busy]
+
+    async def try_acquire(self, port: str) -> bool:
+        """Take the port if it is free and nobody is waiting for it, without waiting."""
+        if self.busy.get(port) or any(self.turns.get(port, {}).values()):
+            return False
+        self.busy[port] = True
+        return True
+
+    @contextlib.contextmanager
+    def claim(self, port: str, loop: asyncio.AbstractEventLoop):
+        """Hold a free port from a worker thread, e.g. while discovery probes it.
+
+        Yields False without waiting when the port is in use, so the caller
+        can skip it. Jobs queued meanwhile run after the port is released.
+        """
+        free = asyncio.run_coroutine_threadsafe(self.try_acquire(port), loop).result()
+        try:
+            yield free
+        finally:
+            if free:
+                loop.call_soon_threadsafe(self.release, port)
+
+    async def acquire(self, port: str, client: Any, priority: int = PRIORITY_INTERACTIVE) -> None:
+        """Wait until the port is granted to the client."""
+        turns_by_priority = self.turns.setdefault(port, {})
+        if not self.busy.get(port) and not any(turns_by_priority.values()):
+            self.busy[port] = True
+            return
+        future = asyncio.get_running_loop().create_future()
+        waiting = self.waiting.setdefault(port, {}).setdefault(priority, {})
+        turns = turns_by_priority.setdefault(priority, collections.deque())
+        if client not in waiting:
+            waiting[client] = collections.deque()
+            turns.append(client)
+        waiting[client].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 権利を受け取った直後にキャンセルされた
+                self.release(port)
+            elif future in waiting.get(client, ()):
+                waiting[client].remove(future)
+            raise
+
+    def release(self, port: str) -> None:
+        """Hand the port to the next job: highest priority first, round-robin over clients."""
+        for priority in sorted(self.turns.get(port, {})):
+            waiting = self.waiting[port][priority]
+            turns = self.turns[port][priority]
+            while turns:
+                client = turns.popleft()
+                queue_ = waiting.get(client)
+                while queue_:
+                    future = queue_.popleft()
+                    if future.cancelled():
+                        continue
+                    if queue_:
+                        turns.append(client)
+                    else:
+                        del waiting[client]
+                    future.set_result(None)
+                    return
+                waiting.pop(client, None)
+        self.busy[port] = False
+
+    async def run(self, port: str, client: Any, job, *args,
+                  priority: int = PRIORITY_INTERACTIVE, timeout: Optional[float] = None) -> Any:
+        """Run job(device, *args) on the connected device of a port.
+
+        The device is connected for the duration of the job, as before, so
+        other programs can use the port between jobs. timeout is the deadline
+        in seconds for waiting in the queue and running the job together.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            await asyncio.wait_for(self.acquire(port, client, priority), timeout)
+        except asyncio.TimeoutError:
+            raise TinySACancelled(f"Timed out waiting for port {port}")
+        self.last_ports[client] = port
+        device = self.device(port)
+        device.cancel_event.clear()
+        device.deadline = deadline
+        worker = asyncio.ensure_future(asyncio.to_thread(self.run_connected, port, job, *args))
+        try:
+            result = await asyncio.shield(worker)
+        except (asyncio.CancelledError, TinySACancelled) as e:
+            # 実行中の転送を中断させ、呼び出し元にはすぐ戻る。
+            # ポートは再同期が終わるまで確保したままにする
+            device.log(f"Aborting command on port {port}: {str(e) or 'cancelled'}", "ERROR")
+            device.cancel_event.set()
+            self.recover(port, worker)
+            raise
+        except BaseException:
+            self.release(port)
+            raise
+        self.release(port)
+        return result
+
+    def run_connected(self, port: str, job, *args) -> Any:
+        device = self.device(port)
+        if not device.connect(port):
+            raise Exception(f"Failed to connect to TinySA on port {port}.")
+        try:
+            return job(device, *args)
+        except TinySACancelled:
+            raise
+        except Exception:
+            # 転送の途中で失敗した場合は残りを読み捨て、次のジョブに持ち越さない
+            device.resync()
+            raise
+        finally:
+            device.disconnect()
+
+    def recover(self, port: str, worker: asyncio.Future) -> None:
+        """Resynchronize a port to the prompt in the background, then release it."""
+        async def recover_port():
+            try:
+                await asyncio.wait([worker])
+                if not worker.cancelled():
+                    worker.exception()  # 例外を取得済みにする
+                await asyncio.to_thread(self.run_connected, port, lambda device: device.resync())
+            except Exception as e:
+                self.log(f"Error recovering port {port}: {e}", "ERROR")
+            finally:
+                self.release(port)
+
+        task = asyncio.ensure_future(recover_port())
+        self.recovering.add(task)
+        task.add_done_callback(self.recovering.discard)
+
+    async def shared(self, port: str, client: Any, key: str, ttl: float, job, *args,
+                     priority: int = PRIORITY_INTERACTIVE, timeout: Optional[float] = None) -> Any:
+        """Run a read-only job, sharing its result with other clients.
+
+        A result younger than ttl seconds is returned from the cache, and a
+        request identical to one already running waits for that one.
+        """
+        cache_key = (port, key)
+        cached = self.cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+        if cache_key in self.inflight:
+            try:
+                return await asyncio.shield(self.inflight[cache_key])
+            except asyncio.CancelledError:
+                # 共有元の要求だけがキャンセルされた場合は自分で実行する
+                if asyncio.current_task().cancelling():
+                    raise
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[cache_key] = future
+        try:
+            result = await self.run(port, client, job, *args, priority=priority, timeout=timeout)
+            self.cache[cache_key] = (time.monotonic(), result)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # 待っている側がいない場合の警告を抑制
+                future.exception()
+            raise
+        finally:
+            del self.inflight[cache_key]
+
+    def invalidate(self, port: str) -> None:
+        """Drop the cached results of a port after its settings changed."""
+        for cache_key in [k for k in self.cache if k[0] == port]:
+            del self.cache[cache_key]
+
+
+def client_key(ctx) -> Any:
+    """Identify the MCP client of a request for fair scheduling."""
+    try:
+        return ctx.client_id or id(ctx.session)
+    except Exception:
+        return None
+
+
 # GUIクラス - シリアル通信のログ表示のみ
 class TinySALogMonitor:
     def __init__(self, root):
@@ -292,21 +2101,50 @@ class TinySALogMonitor:
             self.window_visible = False
 
 # グローバル変数
-tinySA = None
+arbiter = None
+discovery = None
+recipes = None
+sweep_tuner = None
+allocations = None
 log_monitor = None
 
 # MCPサーバー関数の定義
-def create_mcp_server(log_callback):
-    global tinySA
+def create_mcp_server(log_callback, host: str = "127.0.0.1", port: int = 8000):
+    global arbiter, discovery, recipes, sweep_tuner, allocations
     
-    # TinySAシリアルインスタンスを初期化
-    tinySA = TinySASerial(log_callback=log_callback)
+    # ポートごとのTinySAシリアルインスタンスは調停役が管理する
+    arbiter = TinySADeviceArbiter(log_callback=log_callback)
+    discovery = TinySADiscovery(log_callback=log_callback)
+    recipes = TinySARecipeEngine(log_callback=log_callback)
+    sweep_tuner = TinySASweepTuner(log_callback=log_callback)
+    allocations = FrequencyAllocationIndex()
+
+    async def resolve_port(port: Optional[str], device_id: Optional[Union[int, str]], ctx=None) -> Optional[str]:
+        """Resolve the serial port from an explicit port, a cached device id or the client's last port."""
+        if port:
+            return port
+        if device_id is not None and str(device_id) != "":
+            # 他のクライアントが使用中のポートは調べない
+            guard = functools.partial(arbiter.claim, loop=asyncio.get_running_loop())
+            found = await asyncio.to_thread(discovery.find_port, device_id, guard)
+            if not found:
+                arbiter.log(f"No TinySA with device id {device_id} found.", "ERROR")
+            return found
+        return arbiter.last_ports.get(client_key(ctx))
+
+    def missing_port(device_id: Optional[Union[int, str]]) -> str:
+        """Error message for a tool call whose port could not be resolved."""
+        if device_id is not None and str(device_id) != "":
+            return f"No TinySA with device id {device_id} found."
+        return "Port or device_id parameter is required."
     
     # MCPサーバーの初期化
     mcp = FastMCP(
         name="tinySA-operator",
         version="0.1.0",
-        description="MCP server for operating TinySA through serial port"
+        description="MCP server for operating TinySA through serial port",
+        host=host,
+        port=port
     )
 
     @mcp.tool()
@@ -327,116 +2165,783 @@ def create_mcp_server(log_callback):
     
     # ツール関数の登録
     @mcp.tool()
-    async def get_version(port: str) -> Dict[str, Any]:
+    async def discover_devices(force: bool = False) -> Dict[str, Any]:
+        """Find TinySA devices on all serial ports.
+
+        Ports are probed in parallel with short "version"/"deviceid" queries.
+        Ports whose USB identity is unchanged since the last scan, including
+        ports found not to be a TinySA, are answered from the cache without
+        opening them. Ports in use by a running command are not probed, and
+        commands for a port wait while it is being probed.
+
+        Args:
+            force: Probe every port again, ignoring the cache.
+        """
+        try:
+            guard = functools.partial(arbiter.claim, loop=asyncio.get_running_loop())
+            devices = await asyncio.to_thread(discovery.scan, force, True, guard)
+            return {
+                "status": "success",
+                "devices": devices
+            }
+        except Exception as e:
+            discovery.log(f"Error discovering devices: {e}", "ERROR")
+            return {
+                "status": "error",
+                "message": f"Error discovering devices: {str(e)}"
+            }
+
+    @mcp.tool()
+    async def get_version(port: Optional[str] = None, device_id: Optional[Union[int, str]] = None,
+                          ctx: Context = None) -> Dict[str, Any]:
         """Get the version information of the TinySA device.
         
         Args:
             port: Serial port to connect to (explicitly required if not already set)
+            device_id: Device id to look up the port with, instead of giving the port
         """
-        if not port and not tinySA.port:
-            tinySA.log("Port parameter is required.", "ERROR")
+        port = await resolve_port(port, device_id, ctx)
+        if not port:
+            arbiter.log(missing_port(device_id), "ERROR")
             return {
                 "status": "error",
-                "message": "Port parameter is required."
+                "message": missing_port(device_id)
             }
         try:
-            if not tinySA.connect(port):
-                return {
-                    "status": "error",
-                    "message": f"Failed to connect to TinySA on port {port}."
-                }
-            version_info = tinySA.get_version()
+            version_info = await arbiter.shared(port, client_key(ctx), "version", 60,
+                                                lambda device: device.get_version())
             return {
                 "status": "success",
                 "version_info": version_info
             }
         except Exception as e:
-            tinySA.log(f"Error getting TinySA version: {e}", "ERROR")
+            arbiter.log(f"Error getting TinySA version: {e}", "ERROR")
             return {
                 "status": "error",
                 "message": f"Error getting TinySA version: {str(e)}"
             }
-        finally:
-            tinySA.disconnect()
 
     
     @mcp.tool()
-    async def execute_command(command: str, port: str) -> Dict[str, Any]:
+    async def execute_command(command: str, port: Optional[str] = None, device_id: Optional[Union[int, str]] = None,
+                              timeout: Optional[float] = None, ctx: Context = None) -> Dict[str, Any]:
         """Execute a command on the TinySA device.
         
         Args:
             command: Command to execute.
             port: Serial port to connect to (explicitly required if not already set)
+            device_id: Device id to look up the port with, instead of giving the port
+            timeout: Deadline in seconds, including the wait for the port. The command is aborted when it passes.
         """
-        if not port and not tinySA.port:
+        port = await resolve_port(port, device_id, ctx)
+        if not port:
             return {
                 "status": "error",
-                "message": "Port parameter is required."
+                "message": missing_port(device_id)
             }
+
+        def job(device):
+            state = recipes.state(device.port)
+            try:
+                if command.split()[:1] and command.split()[0].lower() == "reset":
+                    # resetは装置を再起動するので、再接続を待つ
+                    device.reset()
+                    response = ""
+                else:
+                    response = device.send_command(command)
+            except Exception:
+                state.forget()
+                raise
+            # シャドーモデルに手動コマンドの影響を反映
+            state.observe(command)
+            return response
+
         try:
-            if not tinySA.connect(port):
-                return {
-                    "status": "error",
-                    "message": f"Failed to connect to TinySA on port {port}."
-                }
-            response = tinySA.send_command(command)
+            response = await arbiter.run(port, client_key(ctx), job, timeout=timeout)
             return {
                 "status": "success",
                 "command": command,
                 "response": response
             }
         except Exception as e:
-            tinySA.log(f"Error executing command: {e}", "ERROR")
+            arbiter.log(f"Error executing command: {e}", "ERROR")
             return {
                 "status": "error",
                 "message": f"Error executing command: {str(e)}"
             }
         finally:
-            tinySA.disconnect()
+            arbiter.invalidate(port)
     
     @mcp.tool()
-    async def get_device_info(port: str) -> Dict[str, Any]:
+    async def list_recipes() -> Dict[str, Any]:
+        """List the named measurement recipes with their parameters and steps."""
+        return {
+            "status": "success",
+            "recipes": recipes.recipes
+        }
+
+    @mcp.tool()
+    async def define_recipe(name: str, steps: List[str], params: Optional[Dict[str, str]] = None,
+                            description: str = "") -> Dict[str, Any]:
+        """Define or replace a named measurement recipe.
+
+        Args:
+            name: Recipe name.
+            steps: TinySA commands, one per step. "{param}" placeholders are filled in when the recipe runs.
+            params: Default values of the placeholders.
+            description: Short description of the measurement.
+        """
+        try:
+            recipes.define(name, steps, params, description)
+            return {
+                "status": "success",
+                "recipe": name
+            }
+        except Exception as e:
+            arbiter.log(f"Error defining recipe: {e}", "ERROR")
+            return {
+                "status": "error",
+                "message": f"Error defining recipe: {str(e)}"
+            }
+
+    @mcp.tool()
+    async def run_recipe(name: str, params: Optional[Dict[str, str]] = None, port: Optional[str] = None,
+                         device_id: Optional[Union[int, str]] = None, diff: bool = True,
+                         timeout: Optional[float] = None, ctx: Context = None) -> Dict[str, Any]:
+        """Run a named measurement recipe on the TinySA device.
+
+        The server keeps a model of the settings it has sent to each device and
+        skips commands that would not change them, so re-running a recipe only
+        sends what differs.
+
+        Args:
+            name: Recipe name (see list_recipes).
+            params: Values for the recipe placeholders. Defaults are used for missing ones.
+            port: Serial port to connect to (explicitly required if not already set)
+            device_id: Device id to look up the port with, instead of giving the port
+            diff: Skip commands that do not change the device state. Set to False to send every command.
+            timeout: Deadline in seconds for the whole recipe, including the wait for the port.
+        """
+        port = await resolve_port(port, device_id, ctx)
+        if not port:
+            return {
+                "status": "error",
+                "message": missing_port(device_id)
+            }
+        try:
+            result = await arbiter.run(port, client_key(ctx), recipes.run, name, params, diff, timeout=timeout)
+            result["status"] = "success"
+            return result
+        except Exception as e:
+            arbiter.log(f"Error running recipe: {e}", "ERROR")
+            return {
+                "status": "error",
+                "message": f"Error running recipe: {str(e)}"
+            }
+        finally:
+            arbiter.invalidate(port)
+
+    @mcp.tool()
+    async def calibrate_sweep_time(port: Optional[str] = None, device_id: Optional[Union[int, str]] = None,
+                                   start: str = "76M", stop: str = "108M",
+                                   timeout: Optional[float] = None,
+                                   ctx: Context = None) -> Dict[str, Any]:
+        """Calibrate the sweep time model of the TinySA device.
+
+        Runs timed scans over a grid of RBW and point counts and stores the
+        fitted model for the device. The RBW is left at the last calibration value.
+
+        Args:
+            port: Serial port to connect to (explicitly required if not already set)
+            device_id: Device id to look up the port with, instead of giving the port
+            start: Start frequency of the calibration sweeps.
+            stop: Stop frequency of the calibration sweeps.
+            timeout: Deadline in seconds for the whole calibration, including the wait for the port.
+        """
+        port = await resolve_port(port, device_id, ctx)
+        if not port:
+            return {
+                "status": "error",
+                "message": missing_port(device_id)
+            }
+        def job(device):
+            state = recipes.state(device.port)
+            try:
+                return sweep_tuner.calibrate(device, parse_frequency(start), parse_frequency(stop),
+                                             state=state)
+            except Exception:
+                # 途中で失敗した場合、RBW等の状態は不明
+                state.forget()
+                raise
+
+        try:
+            result = await arbiter.run(port, client_key(ctx), job,
+                                       priority=TinySADeviceArbiter.PRIORITY_BULK, timeout=timeout)
+            result["status"] = "success"
+            return result
+        except Exception as e:
+            arbiter.log(f"Error calibrating sweep time: {e}", "ERROR")
+            return {
+                "status": "error",
+                "message": f"Error calibrating sweep time: {str(e)}"
+            }
+        finally:
+            arbiter.invalidate(port)
+
+    @mcp.tool()
+    async def tune_sweep(start: str, stop: str, time_budget: Optional[float] = None,
+                         resolution: Optional[str] = None, apply: bool = False,
+                         port: Optional[str] = None, device_id: Optional[Union[int, str]] = None,
+                         ctx: Context = None) -> Dict[str, Any]:
+        """Choose RBW, points and segmentation for a sweep from the calibrated model.
+
+        Args:
+            start: Start frequency (e.g. "76M").
+            stop: Stop frequency (e.g. "108M").
+            time_budget: Wall-clock budget for one sweep in seconds.
+            resolution: Target resolution in Hz (e.g. "100k"). With a time_budget, only settings
+                within the budget are considered; "meets_resolution" reports whether it was reached.
+            apply: Send the chosen RBW and sweep settings to the device (single segment only).
+            port: Serial port to connect to (explicitly required if not already set)
+            device_id: Device id to look up the port with, instead of giving the port
+        """
+        port = await resolve_port(port, device_id, ctx)
+        if not port:
+            return {
+                "status": "error",
+                "message": missing_port(device_id)
+            }
+
+        def job(device):
+            f_start, f_stop = parse_frequency(start), parse_frequency(stop)
+            model = sweep_tuner.model(device)
+            settings = model.tune(f_stop - f_start, time_budget,
+                                  parse_frequency(resolution) if resolution else None)
+            edges = np.linspace(f_start, f_stop, settings["segments"] + 1)
+            settings["segment_ranges"] = [[float(a), float(b)] for a, b in zip(edges[:-1], edges[1:])]
+            result = {"status": "success", "settings": settings}
+            if apply:
+                if settings["segments"] > 1:
+                    result["applied"] = []
+                    result["message"] = "Multiple segments are needed; run one scan per segment range."
+                else:
+                    commands = [f"rbw {settings['rbw']}",
+                                f"sweep {int(f_start)} {int(f_stop)} {settings['points']}"]
+                    state = recipes.state(device.port)
+                    applied = state.plan(commands)
+                    for command in applied:
+                        try:
+                            device.query(command)
+                        except Exception:
+                            state.forget()
+                            raise
+                        state.observe(command)
+                    result["applied"] = applied
+            return result
+
+        try:
+            return await arbiter.run(port, client_key(ctx), job)
+        except Exception as e:
+            arbiter.log(f"Error tuning sweep: {e}", "ERROR")
+            return {
+                "status": "error",
+                "message": f"Error tuning sweep: {str(e)}"
+            }
+        finally:
+            if apply:
+                arbiter.invalidate(port)
+
+    @mcp.tool()
+    async def export_sweeps(path: str, format: Optional[str] = None, count: int = 1,
+                            start: Optional[str] = None, stop: Optional[str] = None, points: int = 450,
+                            interval: float = 0.0, port: Optional[str] = None,
+                            device_id: Optional[Union[int, str]] = None, timeout: Optional[float] = None,
+                            ctx: Context = None) -> Dict[str, Any]:
+        """Acquire sweeps with scanraw and append them to an NPZ, Parquet or CSV file.
+
+        The data is written directly from NumPy arrays; only the file path and
+        summary statistics are returned.
+
+        Args:
+            path: Output file (or directory for Parquet). Relative paths are placed in the 'export' directory.
+            format: "npz", "parquet" or "csv". Inferred from the extension if omitted.
+            count: Number of sweeps to acquire.
+            start: Start frequency (e.g. "76M"). Defaults to the current sweep.
+            stop: Stop frequency (e.g. "108M"). Defaults to the current sweep.
+            points: Number of points per sweep.
+            interval: Seconds to wait between sweeps.
+            port: Serial port to connect to (explicitly required if not already set)
+            device_id: Device id to look up the port with, instead of giving the port
+            timeout: Deadline in seconds for the whole acquisition. Sweeps written before it passes are kept.
+        """
+        port = await resolve_port(port, device_id, ctx)
+        if not port:
+            return {
+                "status": "error",
+                "message": missing_port(device_id)
+            }
+
+        def job(device, exporter):
+            f_start, f_stop = start, stop
+            if f_start is None or f_stop is None:
+                sweep = device.get_sweep()
+                f_start = f_start or sweep["start"]
+                f_stop = f_stop or sweep["stop"]
+            # RBWはシャドーモデルで分かる場合のみ記録
+            rbw = recipes.state(device.port).settings.get("rbw")
+            rbw = rbw if isinstance(rbw, float) else np.nan
+            for i in range(count):
+                if i and interval > 0:
+                    time.sleep(interval)
+                frequencies, levels = device.scan_raw(parse_frequency(f_start), parse_frequency(f_stop), points)
+                exporter.append(frequencies, levels, time.time(), rbw)
+
+        try:
+            if not os.path.isabs(path):
+                export_directory = os.path.join(os.getcwd(), 'export')
+                os.makedirs(export_directory, exist_ok=True)
+                path = os.path.join(export_directory, path)
+            exporter = TraceExporter(path, format)
+            await arbiter.run(port, client_key(ctx), job, exporter,
+                              priority=TinySADeviceArbiter.PRIORITY_BULK, timeout=timeout)
+            arbiter.log(f"Exported {count} sweeps to {path}")
+            result = exporter.summary()
+            result["status"] = "success"
+            return result
+        except Exception as e:
+            arbiter.log(f"Error exporting sweeps: {e}", "ERROR")
+            return {
+                "status": "error",
+                "message": f"Error exporting sweeps: {str(e)}"
+            }
+
+    @mcp.tool()
+    async def load_frequency_database(path: str, replace: bool = False) -> Dict[str, Any]:
+        """Load frequency allocations or stations used by identify_signals.
+
+        The file is a JSON list of objects or a CSV file with a header row. Each
+        entry has "name", optionally "service", and either "start"/"stop" or
+        "frequency"/"bandwidth" (e.g. "80.0M", "200k").
+
+        Args:
+            path: JSON or CSV file to load.
+            replace: Replace the current table (including the built-in allocations) instead of adding to it.
+        """
+        global allocations
+        try:
+            entries = await asyncio.to_thread(FrequencyAllocationIndex.load, path)
+            if replace:
+                index = await asyncio.to_thread(FrequencyAllocationIndex, entries)
+            else:
+                index = FrequencyAllocationIndex(allocations.entries)
+                await asyncio.to_thread(index.add, entries)
+            # 検索中のツールに影響しないよう、新しいインデックスに差し替える
+            allocations = index
+            arbiter.log(f"Loaded {len(entries)} frequency allocations from {path}")
+            return {
+                "status": "success",
+                "loaded": len(entries),
+                "total": len(allocations.entries)
+            }
+        except Exception as e:
+            arbiter.log(f"Error loading frequency database: {e}", "ERROR")
+            return {
+                "status": "error",
+                "message": f"Error loading frequency database: {str(e)}"
+            }
+
+    @mcp.tool()
+    async def identify_signals(port: Optional[str] = None, device_id: Optional[Union[int, str]] = None, source: str = "scanraw",
+                               start: Optional[str] = None, stop: Optional[str] = None, points: int = 450,
+                               threshold: Optional[float] = None, max_peaks: int = 50,
+                               timeout: Optional[float] = None, ctx: Context = None) -> Dict[str, Any]:
+        """Detect the peaks in a sweep and annotate each with its matching allocations.
+
+        All peaks are looked up in the frequency allocation index at once.
+        Matches are listed narrowest first, so a loaded station comes before
+        the band it lies in.
+
+        Args:
+            port: Serial port to connect to (explicitly required if not already set)
+            device_id: Device id to look up the port with, instead of giving the port
+            source: "scanraw" to run a new sweep, or "data" to use the current measurement trace.
+            start: Start frequency for "scanraw" (e.g. "76M"). Defaults to the current sweep.
+            stop: Stop frequency for "scanraw" (e.g. "108M"). Defaults to the current sweep.
+            points: Number of points for "scanraw".
+            threshold: Minimum peak level in dBm. Defaults to 10 dB above the median level.
+            max_peaks: Maximum number of peaks to return, strongest first.
+            timeout: Deadline in seconds for acquiring the data, including the wait for the port.
+        """
+        port = await resolve_port(port, device_id, ctx)
+        if not port:
+            return {
+                "status": "error",
+                "message": missing_port(device_id)
+            }
+        if source not in ("data", "scanraw"):
+            return {
+                "status": "error",
+                "message": f"Unknown source: {source}"
+            }
+
+        def job(device):
+            if source == "scanraw":
+                f_start, f_stop = start, stop
+                if f_start is None or f_stop is None:
+                    sweep = device.get_sweep()
+                    f_start = f_start or sweep["start"]
+                    f_stop = f_stop or sweep["stop"]
+                return device.scan_raw(parse_frequency(f_start), parse_frequency(f_stop), points)
+            return device.get_frequencies(), device.get_trace(2)
+
+        try:
+            key = f"identify:{source}:{start}:{stop}:{points}"
+            priority = TinySADeviceArbiter.PRIORITY_BULK if source == "scanraw" else TinySADeviceArbiter.PRIORITY_INTERACTIVE
+            frequencies, levels = await arbiter.shared(port, client_key(ctx), key, 0.5, job,
+                                                       priority=priority, timeout=timeout)
+            frequencies = np.asarray(frequencies, dtype=np.float64)
+            levels = np.asarray(levels, dtype=np.float64)
+            peaks = find_peaks(frequencies, levels, threshold, max_peaks)
+            matches = allocations.lookup(frequencies[peaks])
+            signals = [{
+                "frequency": float(frequencies[i]),
+                "level": round(float(levels[i]), 2),
+                "allocations": [{"name": e["name"], "service": e["service"],
+                                 "start": e["start"], "stop": e["stop"]} for e in match]
+            } for i, match in zip(peaks.tolist(), matches)]
+            arbiter.log(f"Identified {len(signals)} signals")
+            return {
+                "status": "success",
+                "noise_floor": round(float(np.median(levels)), 2),
+                "signals": signals
+            }
+        except Exception as e:
+            arbiter.log(f"Error identifying signals: {e}", "ERROR")
+            return {
+                "status": "error",
+                "message": f"Error identifying signals: {str(e)}"
+            }
+
+    def recording_path(path: str) -> str:
+        """Place relative recording paths in the 'recordings' directory."""
+        if os.path.isabs(path):
+            return path
+        recording_directory = os.path.join(os.getcwd(), 'recordings')
+        os.makedirs(recording_directory, exist_ok=True)
+        return os.path.join(recording_directory, path)
+
+    @mcp.tool()
+    async def start_recording(path: str, port: Optional[str] = None,
+                              device_id: Optional[Union[int, str]] = None, ctx: Context = None) -> Dict[str, Any]:
+        """Record the raw serial traffic of a device to a binary session file.
+
+        Every byte sent to and received from the device is written with a
+        timestamp until stop_recording is called. The file can be played
+        back with replay_session.
+
+        Args:
+            path: Recording file. Relative paths are placed in the 'recordings' directory.
+            port: Serial port to record (explicitly required if not already set)
+            device_id: Device id to look up the port with, instead of giving the port
+        """
+        port = await resolve_port(port, device_id, ctx)
+        if not port:
+            return {
+                "status": "error",
+                "message": missing_port(device_id)
+            }
+        try:
+            device = arbiter.device(port)
+            if device.recorder is not None:
+                device.recorder.close()
+            path = recording_path(path)
+            device.recorder = SessionRecorder(path)
+            arbiter.log(f"Recording serial traffic of {port} to {path}")
+            return {
+                "status": "success",
+                "port": port,
+                "path": path
+            }
+        except Exception as e:
+            arbiter.log(f"Error starting recording: {e}", "ERROR")
+            return {
+                "status": "error",
+                "message": f"Error starting recording: {str(e)}"
+            }
+
+    @mcp.tool()
+    async def stop_recording(port: Optional[str] = None, device_id: Optional[Union[int, str]] = None,
+                             ctx: Context = None) -> Dict[str, Any]:
+        """Stop recording the serial traffic of a device.
+
+        Args:
+            port: Serial port being recorded (explicitly required if not already set)
+            device_id: Device id to look up the port with, instead of giving the port
+        """
+        port = await resolve_port(port, device_id, ctx)
+        if not port:
+            return {
+                "status": "error",
+                "message": missing_port(device_id)
+            }
+        device = arbiter.devices.get(port)
+        if not device or device.recorder is None:
+            return {
+                "status": "error",
+                "message": f"Port {port} is not being recorded."
+            }
+        path = device.recorder.path
+        device.recorder.close()
+        device.recorder = None
+        arbiter.log(f"Stopped recording {port}")
+        return {
+            "status": "success",
+            "path": path,
+            "size": os.path.getsize(path)
+        }
+
+    @mcp.tool()
+    async def replay_session(path: str, speed: float = 1.0) -> Dict[str, Any]:
+        """Make a recorded session available as a virtual device.
+
+        The returned port name can be passed to any device tool. The device
+        answers with the recorded bytes at the original timing divided by
+        speed (0 for as fast as possible), so tool latency can be measured
+        without hardware.
+
+        Args:
+            path: Recording file. Relative paths are looked up in the 'recordings' directory.
+            speed: Playback speed factor. 1 is real time, 0 delivers data immediately.
+        """
+        try:
+            path = recording_path(path)
+            replay = SessionReplay(path, speed, arbiter.log_callback)
+            port = f"replay:{os.path.basename(path)}"
+            arbiter.device(port).replay = replay
+            arbiter.invalidate(port)
+            return {
+                "status": "success",
+                "port": port,
+                "records": len(replay.records)
+            }
+        except Exception as e:
+            arbiter.log(f"Error loading recording: {e}", "ERROR")
+            return {
+                "status": "error",
+                "message": f"Error loading recording: {str(e)}"
+            }
+
+    @mcp.tool()
+    async def get_device_info(port: Optional[str] = None, device_id: Optional[Union[int, str]] = None,
+                              ctx: Context = None) -> Dict[str, Any]:
         """Get information about the connected TinySA device.
         
         Args:
             port: Serial port to connect to (explicitly required if not already set)
+            device_id: Device id to look up the port with, instead of giving the port
         """
-        if not port and not tinySA.port:
+        port = await resolve_port(port, device_id, ctx)
+        if not port:
             return {
                 "status": "error",
-                "message": "Port parameter is required."
+                "message": missing_port(device_id)
             }
-        try:
-            if not tinySA.connect(port):
-                return {
-                    "status": "error",
-                    "message": f"Failed to connect to TinySA on port {port}."
-                }
+
+        def job(device):
             device_info = {
                 "device": "TinySA",
-                "port": tinySA.port or "Not connected",
-                "connected": tinySA.connected,
-                "baudrate": tinySA.baudrate,
+                "port": device.port or "Not connected",
+                "connected": device.connected,
+                "baudrate": device.baudrate,
             }
             try:
-                device_info.update(tinySA.get_version())
+                device_info.update(device.get_version())
             except Exception as e:
                 device_info["version_error"] = str(e)
+            return device_info
+
+        try:
+            device_info = await arbiter.shared(port, client_key(ctx), "device_info", 60, job)
             return {
                 "status": "success",
                 "device_info": device_info
             }
         except Exception as e:
-            tinySA.log(f"Error getting TinySA info: {e}", "ERROR")
+            arbiter.log(f"Error getting TinySA info: {e}", "ERROR")
             return {
                 "status": "error",
                 "message": f"Error getting TinySA info: {str(e)}"
             }
-        finally:
-            tinySA.disconnect()
     
     @mcp.tool()
-    async def capture_image(port: str, save_name: Optional[str] = None, use_timestamp: bool = False) -> List[Union[types.ImageContent, types.TextContent]]:
+    async def plot_spectrum(port: Optional[str] = None, device_id: Optional[Union[int, str]] = None, source: str = "data",
+                            start: Optional[str] = None, stop: Optional[str] = None, points: int = 450,
+                            overlay_stored: bool = False, show_markers: bool = True,
+                            width: int = 1200, height: int = 700, ref_level: Optional[float] = None,
+                            save_name: Optional[str] = None, use_timestamp: bool = False,
+                            timeout: Optional[float] = None,
+                            ctx: Context = None) -> List[Union[types.ImageContent, types.TextContent]]:
+        """
+        Render a spectrum plot from trace data instead of capturing the device screen.
+
+        Only the trace values are transferred from the device, which is much
+        faster than capture_image, and the plot can be larger than the screen.
+
+        Args:
+            port: Serial port to connect to (explicitly required if not already set)
+            device_id: Device id to look up the port with, instead of giving the port
+            source: "data" to plot the current measurement trace, or "scanraw" to run a new sweep.
+            start: Start frequency for "scanraw" (e.g. "76M"). Defaults to the current sweep.
+            stop: Stop frequency for "scanraw" (e.g. "108M"). Defaults to the current sweep.
+            points: Number of points for "scanraw".
+            overlay_stored: Also draw the stored trace (trace 1).
+            show_markers: Draw the active markers.
+            width: Image width in pixels.
+            height: Image height in pixels.
+            ref_level: Top of the level axis in dBm. Chosen from the data if omitted.
+            save_name: Optional file name to save the plot in the 'img' directory.
+            use_timestamp: Add a timestamp to the saved file name.
+            timeout: Deadline in seconds for acquiring the data, including the wait for the port.
+        """
+        port = await resolve_port(port, device_id, ctx)
+        if not port:
+            arbiter.log(missing_port(device_id), "ERROR")
+            raise Exception(missing_port(device_id))
+        if source not in ("data", "scanraw"):
+            raise Exception(f"Unknown source: {source}")
+
+        def job(device):
+            if source == "scanraw":
+                f_start, f_stop = start, stop
+                if f_start is None or f_stop is None:
+                    sweep = device.get_sweep()
+                    f_start = f_start or sweep["start"]
+                    f_stop = f_stop or sweep["stop"]
+                frequencies, levels = device.scan_raw(parse_frequency(f_start), parse_frequency(f_stop), points)
+            else:
+                frequencies = device.get_frequencies()
+                levels = device.get_trace(2)
+            overlays = [device.get_trace(1)] if overlay_stored else []
+            markers = device.get_markers() if show_markers else []
+            return frequencies, levels, overlays, markers
+
+        def render():
+            im = render_spectrum(frequencies, levels, overlays, markers, width, height, ref_level)
+            save_path = save_to_img_directory(im, save_name, use_timestamp, arbiter.log) if save_name else None
+            buf = io.BytesIO()
+            im.save(buf, format='PNG', optimize=True)
+            return buf.getvalue(), save_path
+
+        response = []
+        try:
+            # 同じ内容の取得は他のクライアントと共有する
+            key = f"plot:{source}:{start}:{stop}:{points}:{overlay_stored}:{show_markers}"
+            priority = TinySADeviceArbiter.PRIORITY_BULK if source == "scanraw" else TinySADeviceArbiter.PRIORITY_INTERACTIVE
+            frequencies, levels, overlays, markers = await arbiter.shared(port, client_key(ctx), key, 0.5, job,
+                                                                          priority=priority, timeout=timeout)
+
+            arbiter.log("Rendering spectrum plot...")
+            png, save_path = await asyncio.to_thread(render)
+            response.append(
+                types.ImageContent(
+                    type="image", data=base64.b64encode(png).decode('utf-8'), mimeType="image/png"
+                )
+            )
+            if save_path:
+                response.append(
+                    types.TextContent(
+                        type="text", text=f"Image saved as: {os.path.basename(save_path)}"
+                    )
+                )
+            arbiter.log("Spectrum plot completed successfully")
+        except Exception as e:
+            arbiter.log(f"Error plotting spectrum: {e}", "ERROR")
+            raise Exception(f"Error plotting spectrum: {e}")
+
+        return response
+
+    @mcp.tool()
+    async def capture_burst_images(port: Optional[str] = None, device_id: Optional[Union[int, str]] = None,
+                                   frames: int = 10, duration: Optional[float] = None,
+                                   save_name: str = "burst.gif", output: str = "gif",
+                                   use_timestamp: bool = False, workers: int = 2,
+                                   timeout: Optional[float] = None, ctx: Context = None) -> Dict[str, Any]:
+        """
+        Capture a sequence of TinySA screens, for example while "calc maxh" accumulates.
+
+        The serial read of each frame overlaps with decoding and encoding of the
+        previous frames on a worker pool (GIF frames are palette-quantized and
+        PNG frames compressed there). The result is written to the 'img'
+        directory and only the path and the achieved frame rate are returned.
+
+        Args:
+            port: Serial port to connect to (explicitly required if not already set)
+            device_id: Device id to look up the port with, instead of giving the port
+            frames: Number of frames to capture (at most 600). Ignored when duration is given.
+            duration: Capture for this many seconds instead of a fixed number of frames.
+            save_name: File name of the animation, or the directory name for "frames".
+            output: "gif" or "png" (animated PNG) for one animated file, "frames" for one PNG per frame.
+            use_timestamp: Add a timestamp to the file or directory name.
+            workers: Number of decoding/encoding threads.
+            timeout: Deadline in seconds for the whole burst, including the wait for the port.
+        """
+        port = await resolve_port(port, device_id, ctx)
+        if not port:
+            return {
+                "status": "error",
+                "message": missing_port(device_id)
+            }
+        if output not in ("gif", "png", "frames"):
+            return {
+                "status": "error",
+                "message": f"Unknown output: {output}"
+            }
+
+        name, extension = os.path.splitext(os.path.basename(save_name))
+        if use_timestamp:
+            name = f"{name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        img_directory = os.path.join(os.getcwd(), 'img')
+        if output == "frames":
+            save_path = os.path.join(img_directory, name)
+            os.makedirs(save_path, exist_ok=True)
+        else:
+            os.makedirs(img_directory, exist_ok=True)
+            save_path = os.path.join(img_directory, f"{name}.{output}")
+
+        try:
+            result = await arbiter.run(port, client_key(ctx), capture_burst, frames, duration, output,
+                                       save_path if output == "frames" else None, workers,
+                                       priority=TinySADeviceArbiter.PRIORITY_BULK, timeout=timeout)
+            encoded = result.pop("encoded")
+            times = result.pop("times")
+            if not encoded:
+                raise Exception("No frames captured")
+            # フレーム間隔を実際のキャプチャ間隔に合わせる
+            durations = [max(int((b - a) * 1000), 20) for a, b in zip(times, times[1:])] or [100]
+            durations.append(durations[-1])
+            if output == "gif":
+                await asyncio.to_thread(encoded[0].save, save_path, save_all=True,
+                                        append_images=encoded[1:], duration=durations, loop=0)
+            elif output == "png":
+                await asyncio.to_thread(write_apng, save_path, encoded, durations)
+            else:
+                result["files"] = [os.path.basename(path) for path in encoded]
+                result["frame_times"] = [round(t, 3) for t in times]
+            arbiter.log(f"Burst of {result['frames']} frames saved to {save_path} "
+                        f"({result['capture_fps']:.2f} fps captured)")
+            result.update({"status": "success", "path": save_path, "output": output})
+            return result
+        except Exception as e:
+            arbiter.log(f"Error capturing burst: {e}", "ERROR")
+            return {
+                "status": "error",
+                "message": f"Error capturing burst: {str(e)}"
+            }
+
+    @mcp.tool()
+    async def capture_image(port: Optional[str] = None, save_name: Optional[str] = None, use_timestamp: bool = False,
+                            device_id: Optional[Union[int, str]] = None, timeout: Optional[float] = None,
+                            ctx: Context = None) -> List[Union[types.ImageContent, types.TextContent]]:
         """
         Capture the TinySA screen image from the device and return it as an MCP Image.
         
@@ -450,59 +2955,30 @@ def create_mcp_server(log_callback):
                     If provided, the image is saved to the specified file name.
             use_timestamp: Controls whether to add a timestamp to the filename.
                         Only applicable when save_path is provided.
+            device_id: Device id to look up the port with, instead of giving the port
+            timeout: Deadline in seconds for the capture, including the wait for the port.
         """
-        if not port and not tinySA.port:
-            tinySA.log("Port parameter is required.", "ERROR")
-            raise Exception("Port parameter is required.")
+        port = await resolve_port(port, device_id, ctx)
+        if not port:
+            arbiter.log(missing_port(device_id), "ERROR")
+            raise Exception(missing_port(device_id))
         
         response = []  # レスポンスの初期化をtryブロックの外に移動
         
         try:
-            if not tinySA.connect(port):
-                tinySA.log(f"Failed to connect to TinySA on port {port}.", "ERROR")
-                raise Exception(f"Failed to connect to TinySA on port {port}.")
-            b = tinySA.get_image_data()
+            b = await arbiter.shared(port, client_key(ctx), "capture", 0.2,
+                                     lambda device: device.get_image_data(),
+                                     priority=TinySADeviceArbiter.PRIORITY_BULK, timeout=timeout)
             if len(b) < 307200:
-                tinySA.log(f"Insufficient data captured from device. len(data): {len(b)} < 307200", "ERROR")
+                arbiter.log(f"Insufficient data captured from device. len(data): {len(b)} < 307200", "ERROR")
                 raise Exception(f"Insufficient data captured from device. len(data): {len(b)} < 307200")
             
-            tinySA.log("Processing image data...")
-            a = b[0:307200]
-            x = struct.unpack(">153600H", a)
-            arr = np.array(x, dtype=np.uint32)
-            # 画像を適切なサイズに整形
-            width = 480
-            height = 320
-            reshaped = arr.reshape(height, width)
-            # そのままだとずれるので、少しシフトする
-            shift_amount = width // 100  # 画面を見て調整
-            # 各行をシフトして修正
-            fixed_array = np.zeros_like(reshaped)
-            for i in range(height):
-                fixed_array[i] = np.roll(reshaped[i], -shift_amount)  # マイナス値で右シフト
-            # 修正した配列を平坦化
-            fixed_arr = fixed_array.flatten()
-            # 色変換を続行
-            fixed_arr = 0xFF000000 + ((fixed_arr & 0xF800) >> 8) + ((fixed_arr & 0x07EF) << 8) + ((fixed_arr & 0x001F) << 19)
-            im = PILImage.frombuffer('RGBA', (480, 320), fixed_arr, 'raw', 'RGBA', 0, 1)
+            arbiter.log("Processing image data...")
+            im = await asyncio.to_thread(decode_screen, b)
             
             # Save image to file if a path is specified
             if save_name:
-                if use_timestamp:
-                    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-                    path_parts = os.path.splitext(save_name)
-                    save_name = f"{path_parts[0]}_{timestamp}{path_parts[1]}"
-
-                # Create 'img' directory in the current directory
-                img_directory = os.path.join(os.getcwd(), 'img')
-                os.makedirs(img_directory, exist_ok=True)
-
-                # Update save_name to be within the img directory
-                filename = os.path.basename(save_name)
-                save_path = os.path.join(img_directory, filename)
-
-                im.save(save_path)
-                tinySA.log(f"Image saved to {save_path}")
+                save_path = save_to_img_directory(im, save_name, use_timestamp, arbiter.log)
                 saved_filename = os.path.basename(save_path)
             
             buf = io.BytesIO()
@@ -524,12 +3000,10 @@ def create_mcp_server(log_callback):
                     )
                 )
             
-            tinySA.log("Image capture completed successfully")
+            arbiter.log("Image capture completed successfully")
         except Exception as e:
-            tinySA.log(f"Error capturing image: {e}", "ERROR")
+            arbiter.log(f"Error capturing image: {e}", "ERROR")
             raise Exception(f"Error capturing image: {e}")
-        finally:
-            tinySA.disconnect()
         
         return response
      
@@ -537,9 +3011,16 @@ def create_mcp_server(log_callback):
     return mcp
 
 # MCPサーバー実行用の関数
-def run_mcp_server(mcp_server):
+# インストールされているFastMCPが対応するトランスポート
+MCP_TRANSPORTS = ["stdio", "sse"] + (["streamable-http"] if hasattr(FastMCP, "streamable_http_app") else [])
+
+
+def run_mcp_server(mcp_server, transport: str = 'stdio'):
     # MCPサーバーの実行（この関数は別スレッドで実行される）
-    mcp_server.run(transport='stdio')
+    try:
+        mcp_server.run(transport=transport)
+    except Exception as e:
+        arbiter.log(f"MCP server stopped: {e}", "ERROR")
     # サーバーrun()終了時にGUIも閉じる
     if log_monitor and hasattr(log_monitor, 'root'):
         log_monitor.root.after(0, log_monitor.root.destroy)
@@ -547,6 +3028,15 @@ def run_mcp_server(mcp_server):
 # メイン関数
 def main():
     global log_monitor
+
+    # コマンドライン引数（ネットワーク経由で複数クライアントから使う場合はsse等を指定）
+    parser = argparse.ArgumentParser(description="MCP server for operating TinySA through serial port")
+    parser.add_argument("--transport", choices=MCP_TRANSPORTS, default="stdio",
+                        help="MCP transport. Network transports (sse, and streamable-http when the "
+                             "installed mcp supports it) let several clients share one server.")
+    parser.add_argument("--host", default="127.0.0.1", help="Listen address for network transports")
+    parser.add_argument("--port", type=int, default=8000, help="Listen port for network transports")
+    args = parser.parse_args()
     
     # Tkのルートウィンドウを作成
     root = tk.Tk()
@@ -555,13 +3045,15 @@ def main():
     log_monitor = TinySALogMonitor(root)
     
     # MCPサーバーの初期化
-    mcp_server = create_mcp_server(log_monitor.add_log)
+    mcp_server = create_mcp_server(log_monitor.add_log, args.host, args.port)
     
     # 初期ログメッセージ
     log_monitor.add_log("[INFO] TinySA MCP Server Log Monitor started")
+    if args.transport != "stdio":
+        log_monitor.add_log(f"[INFO] Serving {args.transport} on {args.host}:{args.port}")
     
     # MCPサーバーを別スレッドで実行
-    mcp_thread = threading.Thread(target=run_mcp_server, args=(mcp_server,), daemon=True)
+    mcp_thread = threading.Thread(target=run_mcp_server, args=(mcp_server, args.transport), daemon=True)
     mcp_thread.start()
     
     # メインスレッドでGUIを実行
@@ -569,4 +3061,4 @@ def main():
 
 # プログラム開始
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()